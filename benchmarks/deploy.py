@@ -0,0 +1,393 @@
+"""
+Benchmarks the bake, deploy, abort, warm_up, confirm and rollback tasks from
+templates/aws/fabfile.py end to end against the offline fake AWS backend in
+fakeaws.py.
+
+    python benchmarks/deploy.py
+    python benchmarks/deploy.py --sizes 1,10 --update-baseline
+
+For each fleet size the backend is seeded with a project between releases:
+a load balancer, a logging instance and an Active group of that size. We
+then run bake, deploy, abort, deploy again, warm_up, confirm and rollback,
+each in a fresh process like ``fab`` would, timing every task and counting
+the API calls the backend answered for it. Checks for code the tasks don't
+reach run first the same way.
+
+Results are compared with benchmarks/deploy-baseline.json and the script
+exits non-zero if a task got slower or made more API calls than the
+thresholds allow. Nothing talks to AWS or any other host.
+"""
+import os
+import imp
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+import functools
+import subprocess
+
+import fakeaws
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+FABFILE = os.path.join(ROOT, 'templates', 'aws', 'fabfile.py')
+BASELINE = os.path.join(ROOT, 'benchmarks', 'deploy-baseline.json')
+
+SIZES = [1, 10, 50]
+
+"""
+The tasks run against each fleet size, and the name each is reported under.
+The deploys launch from the baked AMI and the second one just sets up a QA
+group for confirm.
+"""
+TASKS = [
+    ('check_elb_tags', None),
+    ('bake', 'bake'),
+    ('deploy', 'deploy'),
+    ('abort', 'abort'),
+    ('deploy', None),
+    ('warm_up', 'warm up'),
+    ('confirm', 'confirm'),
+    ('rollback', 'rollback'),
+]
+
+"""
+With --standby-pool the first deploy also starts a standby group, which the
+second deploy promotes.
+"""
+STANDBY_TASKS = [
+    ('check_elb_tags', None),
+    ('bake', 'bake'),
+    ('deploy', 'deploy'),
+    ('abort', 'abort'),
+    ('deploy', 'warm deploy'),
+    ('warm_up', 'warm up'),
+    ('confirm', 'confirm'),
+    ('rollback', 'rollback'),
+]
+
+"""
+How long the fake AWS services take to respond and to change state, in
+seconds. They're scaled down from AWS so a run takes minutes, not hours.
+"""
+TIMINGS = {
+    'latency': 0.05,
+    'boot_delay': 5,
+    'dns_delay': 1,
+    'launch_delay': 2,
+    'health_delay': 4,
+    'sync_delay': 3,
+    'volume_delay': 1,
+    'bake_delay': 10,
+    'image_delay': 3,
+}
+
+"""
+Regressions smaller than this many seconds are put down to noise.
+"""
+TIME_SLACK = 1.0
+
+SERVICES = [
+    'boto.ec2',
+    'boto.ec2.elb',
+    'boto.ec2.autoscale',
+    'boto.ec2.cloudwatch',
+    'boto.route53',
+    'boto.s3']
+
+PROJECT = 'bench'
+ENVIRONMENT = 'stage'
+REGION = 'eu-west-1'
+ZONES = ['eu-west-1a', 'eu-west-1b', 'eu-west-1c']
+
+
+def configure(env, size, workdir, standby_pool=False):
+    """
+    Settings along the lines of the stage task in templates/aws/fabconfig.py
+    for a fleet of ``size`` instances.
+    """
+    env.region = REGION
+    env.profile_name = None
+    env.project = PROJECT
+    env.environment = ENVIRONMENT
+    env.app_docker_image = '%s-app' % PROJECT
+    env.nginx_docker_image = '%s-nginx' % PROJECT
+    env.logstash_docker_image = '%s-logstash' % PROJECT
+    env.elasticsearch_docker_image = '%s-elasticsearch' % PROJECT
+    env.kibana_docker_image = '%s-kibana' % PROJECT
+    env.logging_ami_id = 'ami-10000000'
+    env.ami_image_id = 'ami-20000000'
+    env.zones = ZONES
+    env.s3_bootstrap_bucket = '%s-bootstrap' % PROJECT
+    env.bootstrap_folder = 'bootstrap'
+    env.zone = 'example.com.'
+    env.qa_urls = ['www.qa%s.example.com.']
+    env.urls = ['www.example.com']
+    env.base_url = 'example.com'
+    env.logging_urls = ['logs.%s-%s.example.com' % (PROJECT, ENVIRONMENT)]
+    env.load_balancer_name = '%s-%s' % (PROJECT, ENVIRONMENT)
+    env.instance_type = 't2.medium'
+    env.docker_host = 'registry.example.com'
+    env.security_groups = [ENVIRONMENT]
+    env.basic_auth = ''
+    env.elasticsearch_host = ''
+    env.ttl_in_seconds = 60
+    env.r53_ttl = 60
+    env.logging_ebs_volume_size = 100
+    env.logging_ebs_volume_type = 'gp2'
+
+    env.asg_desired_capacity = size
+    env.asg_min_size = size
+    env.asg_max_size = size
+    env.asg_adjustment_up = 1
+    env.asg_adjustment_down = -1
+    env.asg_default_cooldown = 180
+
+    env.hosts = ['nagios.example.com']
+    env.nagios_group_name = PROJECT
+    env.nagios_master_config_file = 'bootstrap/nagios/nagios.cfg'
+    env.nagios_master_config_dir = '/etc/nagios3/aws.%s' % PROJECT
+
+    env.cw_namespace = 'AWS/EC2'
+    env.cw_metric = 'CPUUtilization'
+    env.cw_statistic = 'Average'
+    env.cw_comparison_gt = '>'
+    env.cw_comparison_lt = '<'
+    env.cw_threshold_up = '50'
+    env.cw_threshold_down = '20'
+    env.cw_period = '60'
+    env.cw_evaluation_periods = 1
+
+    env.standby_pool = standby_pool
+    env.warm_up_urls = ['/', '/about/', '/products/', '/basket/']
+
+    # Waiters back off less, in line with the fake's shorter timings
+    env.waiter_max_delay = 4
+
+    env.trace_dir = os.path.join(workdir, 'traces')
+    env.template_cache_dir = os.path.join(workdir, '.template-cache')
+
+
+def seed(backend, size):
+    backend.add_security_group(ENVIRONMENT)
+    backend.add_zone('example.com.')
+    backend.add_bucket('%s-bootstrap' % PROJECT)
+    load_balancer_name = '%s-%s' % (PROJECT, ENVIRONMENT)
+    backend.add_load_balancer(name=load_balancer_name, zones=ZONES)
+    backend.add_instance(
+        zone=ZONES[0], tags={'Name': '%s-logger' % PROJECT})
+    backend.add_group(
+        name='asg-%s-%s-previous' % (PROJECT, ENVIRONMENT),
+        launch_configuration='lc-%s-previous' % PROJECT,
+        size=size,
+        zones=ZONES,
+        load_balancers=[load_balancer_name],
+        tags={'env': ENVIRONMENT, 'type': 'Active',
+              'Name': '%s-%s' % (PROJECT, ENVIRONMENT)})
+
+
+def check_elb_tags(env):
+    """
+    Nothing in the fabfile tags load balancers yet, so this checks the ELB
+    tag client against the fake on its own.
+    """
+    from tangentdeployer.aws import elb
+    load_balancer = elb.get(load_balancer_name=env.load_balancer_name)
+    elb.tag(load_balancer=load_balancer, tags={'env': ENVIRONMENT,
+                                               'type': 'Active'})
+    elb.tag_cache.clear()
+    tags = elb.get_tags(load_balancer_names=[load_balancer.name])
+    if tags != {load_balancer.name: {'env': ENVIRONMENT, 'type': 'Active'}}:
+        raise SystemExit('DescribeTags was parsed as %r' % tags)
+    if not elb.has_tag(load_balancer_name=load_balancer.name, key='type',
+                       value='Active') or \
+            elb.has_tag(load_balancer_name=load_balancer.name, key='type',
+                        value='QA'):
+        raise SystemExit('has_tag got the load balancer tags wrong')
+
+
+"""
+Checks run like tasks, for code the fabfile tasks don't reach.
+"""
+CHECKS = {
+    'check_elb_tags': check_elb_tags,
+}
+
+
+def run_task(task_name, size, endpoints, workdir, result_path,
+             standby_pool=False):
+    """
+    Run a fabfile task in this process against the fake backend, as
+    ``fab stage <task>`` would against AWS.
+    """
+    sys.path.insert(0, os.path.join(ROOT, 'src'))
+    from fabric.api import env
+
+    fabconfig = types.ModuleType('fabconfig')
+    fabconfig.env = env
+    sys.modules['fabconfig'] = fabconfig
+    configure(env, size=size, workdir=workdir, standby_pool=standby_pool)
+
+    from tangentdeployer.aws import ec2, pool, standby, utils, warmup
+    pool.connection_pool.open = functools.partial(
+        fakeaws.connect, endpoints=endpoints)
+    nagios_master = fakeaws.FakeHost(latency=TIMINGS['latency'])
+    ec2.put = nagios_master.put
+    ec2.run = nagios_master.run
+    app_hosts = fakeaws.FakeHost(latency=TIMINGS['latency'])
+    standby.put = app_hosts.put
+    standby.sudo = app_hosts.run
+    warmup.urlopen = fakeaws.FakeSite().urlopen
+    env.connections = utils.BotoConnection(
+        profile_name=None, services=SERVICES)
+
+    fabfile = imp.load_source('fabfile', FABFILE)
+    start = time.time()
+    if task_name in CHECKS:
+        CHECKS[task_name](env)
+    else:
+        getattr(fabfile, task_name)()
+    with open(result_path, 'w') as result_file:
+        json.dump({'seconds': time.time() - start}, result_file)
+
+
+def benchmark(size, rate_limits=None, standby_pool=False):
+    backend = fakeaws.FakeAWS(
+        region=REGION, rate_limits=rate_limits, **TIMINGS).start()
+    workdir = tempfile.mkdtemp(prefix='deploy-benchmark-')
+    try:
+        seed(backend, size=size)
+        shutil.copytree(os.path.join(ROOT, 'bootstrap'),
+                        os.path.join(workdir, 'bootstrap'))
+        results = {}
+        for task_name, label in STANDBY_TASKS if standby_pool else TASKS:
+            result_path = os.path.join(workdir, 'result.json')
+            log_path = os.path.join(workdir, '%s.log' % task_name)
+            before = backend.request_counts()
+            with open(log_path, 'w') as log:
+                returncode = subprocess.call(
+                    [sys.executable, os.path.abspath(__file__), '--run',
+                     task_name, str(size), json.dumps(backend.endpoints()),
+                     workdir, result_path, str(int(standby_pool))],
+                    cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+            if returncode != 0:
+                with open(log_path) as log:
+                    sys.stdout.write(log.read())
+                raise SystemExit('%s failed with %d instances' % (
+                    task_name, size))
+            calls = backend.request_counts()
+            calls.subtract(before)
+            with open(result_path) as result_file:
+                seconds = json.load(result_file)['seconds']
+            if label:
+                results[label] = {
+                    'seconds': round(seconds, 2),
+                    'api_calls': sum(calls.values()),
+                    'operations': dict(
+                        ('%s %s' % key, count)
+                        for key, count in calls.items() if count),
+                }
+        return results
+    finally:
+        backend.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def compare(results, baseline, time_threshold, calls_threshold):
+    """
+    Print a results table and return a list of regressions against the
+    baseline.
+    """
+    regressions = []
+    row = '%5s  %-8s %9s %10s %10s %11s'
+    print(row % ('Size', 'Task', 'Seconds', 'Baseline', 'API calls',
+                 'Baseline'))
+    for size, tasks in sorted(results.items(), key=lambda item: int(item[0])):
+        for label, result in sorted(tasks.items()):
+            base = baseline.get(size, {}).get(label)
+            print(row % (size, label, '%.1f' % result['seconds'],
+                         '%.1f' % base['seconds'] if base else '-',
+                         result['api_calls'],
+                         base['api_calls'] if base else '-'))
+            if not base:
+                continue
+            if result['seconds'] > base['seconds'] * (1 + time_threshold) \
+                    + TIME_SLACK:
+                regressions.append('%s with %s instances took %.1fs, the '
+                                   'baseline is %.1fs' % (
+                                       label, size, result['seconds'],
+                                       base['seconds']))
+            if result['api_calls'] > \
+                    base['api_calls'] * (1 + calls_threshold):
+                regressions.append('%s with %s instances made %d API calls, '
+                                   'the baseline is %d' % (
+                                       label, size, result['api_calls'],
+                                       base['api_calls']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated fleet sizes')
+    parser.add_argument('--time-threshold', type=float, default=0.2,
+                        help='allowed fractional increase in wall time')
+    parser.add_argument('--calls-threshold', type=float, default=0.1,
+                        help='allowed fractional increase in API calls')
+    parser.add_argument('--rate-limits', default='',
+                        help='throttle the fake account, e.g. '
+                             'autoscale=2,route53=1 (requests per second)')
+    parser.add_argument('--standby-pool', action='store_true',
+                        help='deploy with a warm standby pool')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='save these results as the new baseline')
+    parser.add_argument('--output', help='also write the results here')
+    args = parser.parse_args()
+
+    rate_limits = dict(
+        (service, float(rate))
+        for service, rate in (
+            limit.split('=') for limit in args.rate_limits.split(',')
+            if limit))
+
+    results = {}
+    for size in [int(size) for size in args.sizes.split(',')]:
+        print('Benchmarking %d instances...' % size)
+        results[str(size)] = benchmark(size=size, rate_limits=rate_limits,
+                                       standby_pool=args.standby_pool)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = compare(results, baseline=baseline,
+                          time_threshold=args.time_threshold,
+                          calls_threshold=args.calls_threshold)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+        print('Baseline written to %s' % args.baseline)
+    elif regressions:
+        print('')
+        for regression in regressions:
+            print('REGRESSION: %s' % regression)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        task_name, size, endpoints, workdir, result_path, standby_pool = \
+            sys.argv[2:]
+        run_task(task_name, size=int(size), endpoints=json.loads(endpoints),
+                 workdir=workdir, result_path=result_path,
+                 standby_pool=bool(int(standby_pool)))
+    else:
+        main()
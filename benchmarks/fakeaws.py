@@ -0,0 +1,1445 @@
+"""
+An in-memory, offline stand-in for the AWS services a deploy talks to: EC2,
+ELB, Auto Scaling, CloudWatch, Route53 and S3.
+
+Each service is served over HTTP on a loopback port and the connections
+``env.connections`` hands out are ordinary boto connections pointed at it,
+so deploys run through the same boto code paths (and the same API call
+metering) as they do against AWS. Nothing leaves the machine.
+
+Time moves on as it does in AWS: instances take ``boot_delay`` seconds to
+start running and another ``dns_delay`` to get a public DNS name, Auto
+Scaling takes ``launch_delay`` to launch instances after a group's capacity
+changes, ELB reports instances healthy ``health_delay`` seconds after they
+are registered and running, and Route53 changes take ``sync_delay`` to go
+INSYNC. Instances launched to bake an AMI shut themselves down
+``bake_delay`` seconds after they start running, and new AMIs take
+``image_delay`` to become available. Every request takes ``latency``
+seconds to answer, and services in ``rate_limits`` throttle requests beyond
+that many per second.
+
+    backend = FakeAWS(latency=0.05, boot_delay=5)
+    backend.start()
+    pool.connection_pool.open = functools.partial(
+        connect, endpoints=backend.endpoints())
+"""
+import re
+import time
+import uuid
+import base64
+import hashlib
+import subprocess
+import itertools
+import threading
+import collections
+import BaseHTTPServer
+import SocketServer
+import urlparse
+
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+import boto.ec2
+import boto.ec2.elb
+import boto.ec2.autoscale
+import boto.ec2.cloudwatch
+import boto.route53
+import boto.s3.connection
+
+from boto.regioninfo import RegionInfo
+
+ACCOUNT_ID = '123456789012'
+
+ELB_HOSTED_ZONE_ID = 'Z32O12XQLNTSW2'
+
+"""
+The error each service answers with when the account's request rate is
+exceeded.
+"""
+THROTTLING_ERRORS = {
+    'ec2': ('RequestLimitExceeded', 503),
+    's3': ('SlowDown', 503),
+}
+DEFAULT_THROTTLING_ERROR = ('Throttling', 400)
+
+INSTANCE_STATE_CODES = {
+    'pending': 0,
+    'running': 16,
+    'shutting-down': 32,
+    'terminated': 48,
+    'stopped': 80,
+}
+
+SERVICES = ['ec2', 'elb', 'autoscale', 'cloudwatch', 'route53', 's3']
+
+
+class FakeAWSError(Exception):
+
+    def __init__(self, code, message='', status=400):
+        super(FakeAWSError, self).__init__(message or code)
+        self.code = code
+        self.message = message or code
+        self.status = status
+
+
+class FakeAWS(object):
+
+    def __init__(self, region='eu-west-1', latency=0.05, boot_delay=5,
+                 dns_delay=1, launch_delay=2, health_delay=4, sync_delay=3,
+                 volume_delay=1, bake_delay=10, image_delay=3,
+                 rate_limits=None):
+        self.region = region
+        self.latency = latency
+        self.boot_delay = boot_delay
+        self.dns_delay = dns_delay
+        self.launch_delay = launch_delay
+        self.health_delay = health_delay
+        self.sync_delay = sync_delay
+        self.volume_delay = volume_delay
+        self.bake_delay = bake_delay
+        self.image_delay = image_delay
+        self.rate_limits = rate_limits or {}
+        self.allowance = {}
+
+        self.lock = threading.RLock()
+        self.ids = itertools.count(1)
+        self.servers = {}
+        self.requests = collections.Counter()
+
+        self.instances = collections.OrderedDict()
+        self.volumes = collections.OrderedDict()
+        self.images = collections.OrderedDict()
+        self.addresses = collections.OrderedDict()
+        self.security_groups = collections.OrderedDict()
+        self.load_balancers = collections.OrderedDict()
+        self.groups = collections.OrderedDict()
+        self.launch_configurations = collections.OrderedDict()
+        self.policies = collections.OrderedDict()
+        self.alarms = collections.OrderedDict()
+        self.zones = collections.OrderedDict()
+        self.changes = {}
+        self.buckets = collections.OrderedDict()
+
+    # Serving
+
+    def start(self):
+        for service in SERVICES:
+            server = Server(('127.0.0.1', 0), Handler)
+            server.backend = self
+            server.service = service
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.servers[service] = server
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            server.shutdown()
+            server.server_close()
+        self.servers = {}
+
+    def endpoints(self):
+        return dict(
+            (service, server.server_address[1])
+            for service, server in self.servers.items()
+        )
+
+    def request_counts(self):
+        with self.lock:
+            return collections.Counter(self.requests)
+
+    def handle(self, service, method, path, query, headers, body):
+        time.sleep(self.latency)
+        if service == 's3':
+            operation = '%s %s' % (method, 'Object' if '/' in path.strip('/')
+                                   else 'Bucket')
+        elif service == 'route53':
+            operation = '%s %s' % (method, '/'.join(
+                part for part in path.split('/')
+                if part.isalpha() and part.islower()))
+        else:
+            params = dict(urlparse.parse_qsl(body or query,
+                                             keep_blank_values=True))
+            operation = params.get('Action')
+
+        with self.lock:
+            self.requests[(service, operation)] += 1
+            now = time.time()
+            try:
+                self.check_rate_limit(service, now)
+                if service == 's3':
+                    return self.s3(method, path, query, headers, body)
+                if service == 'route53':
+                    return self.route53(method, path, query, body, now)
+                handler = getattr(self, '%s_%s' % (service, operation), None)
+                if handler is None:
+                    raise FakeAWSError(
+                        'InvalidAction', '%s is not supported' % operation)
+                return 200, {}, query_response(
+                    service=service, action=operation,
+                    result=handler(params, now))
+            except FakeAWSError as e:
+                return e.status, {}, error_response(service=service, error=e)
+
+    def check_rate_limit(self, service, now):
+        """
+        Throttle requests beyond ``rate_limits[service]`` per second, with
+        a second's worth of burst, like AWS does per account.
+        """
+        rate = self.rate_limits.get(service)
+        if not rate:
+            return
+        allowance, updated = self.allowance.get(service, (rate, now))
+        allowance = min(rate, allowance + (now - updated) * rate)
+        if allowance < 1:
+            self.allowance[service] = (allowance, now)
+            code, status = THROTTLING_ERRORS.get(
+                service, DEFAULT_THROTTLING_ERROR)
+            raise FakeAWSError(code, 'Rate exceeded', status=status)
+        self.allowance[service] = (allowance - 1, now)
+
+    def new_id(self, prefix):
+        return '%s-%08x' % (prefix, next(self.ids))
+
+    # Seeding
+
+    def add_security_group(self, name):
+        with self.lock:
+            self.security_groups[name] = self.new_id('sg')
+
+    def add_zone(self, name):
+        with self.lock:
+            zone_id = 'Z%012d' % next(self.ids)
+            self.zones[zone_id] = {'name': name, 'records': {}}
+            return zone_id
+
+    def add_bucket(self, name):
+        with self.lock:
+            self.buckets[name] = collections.OrderedDict()
+
+    def add_address(self):
+        with self.lock:
+            index = next(self.ids)
+            public_ip = '52.16.%d.%d' % (index // 250, index % 250 + 1)
+            self.addresses[public_ip] = {'instance_id': None}
+            return public_ip
+
+    def add_load_balancer(self, name, zones):
+        with self.lock:
+            params = dict(
+                ('AvailabilityZones.member.%d' % (index + 1), zone)
+                for index, zone in enumerate(zones))
+            params['LoadBalancerName'] = name
+            self.elb_CreateLoadBalancer(params, time.time())
+
+    def add_group(self, name, launch_configuration, size, zones,
+                  load_balancers=(), tags=None, running=True):
+        """
+        An Auto Scaling group whose instances are already up, e.g. the
+        Active group of a previous deploy.
+        """
+        with self.lock:
+            now = time.time()
+            started = now - 3600 if running else now
+            self.launch_configurations[launch_configuration] = {
+                'image_id': 'ami-00000000', 'created': now}
+            self.groups[name] = {
+                'launch_configuration': launch_configuration,
+                'min_size': size,
+                'max_size': size,
+                'desired_capacity': size,
+                'zones': list(zones),
+                'load_balancers': list(load_balancers),
+                'tags': collections.OrderedDict(
+                    (key, (value, key == 'Name'))
+                    for key, value in (tags or {}).items()),
+                'suspended': set(),
+                'instances': [],
+                'scheduled': [],
+                'capacity_changed': started - self.launch_delay,
+                'created': started,
+            }
+            for index in range(size):
+                instance_id = self.launch(
+                    zone=zones[index % len(zones)], now=started,
+                    tags=self.propagated_tags(self.groups[name]),
+                    group=name)
+                self.groups[name]['instances'].append(instance_id)
+                for load_balancer_name in load_balancers:
+                    self.load_balancers[load_balancer_name]['instances'][
+                        instance_id] = started
+
+    def add_instance(self, zone, tags=None, running=True):
+        with self.lock:
+            now = time.time()
+            if running:
+                now -= 3600
+            return self.launch(zone=zone, now=now, tags=tags or {})
+
+    # Simulation
+
+    def launch(self, zone, now, tags, group=None, image_id='ami-00000000'):
+        number = next(self.ids)
+        instance_id = 'i-%08x' % number
+        self.instances[instance_id] = {
+            'number': number,
+            'image_id': image_id,
+            'zone': zone,
+            'launched': now,
+            'terminated': None,
+            'tags': collections.OrderedDict(tags),
+            'group': group,
+            'public_ip': None,
+            'stops': None,
+        }
+        return instance_id
+
+    def instance_state(self, instance, now):
+        if instance['terminated'] is not None:
+            return 'terminated'
+        if instance['stops'] is not None and now >= instance['stops']:
+            return 'stopped'
+        if now < instance['launched'] + self.boot_delay:
+            return 'pending'
+        return 'running'
+
+    def dns_name(self, instance, now):
+        if self.instance_state(instance, now) != 'running' or \
+                now < instance['launched'] + self.boot_delay + self.dns_delay:
+            return ''
+        if instance['public_ip']:
+            address = instance['public_ip'].replace('.', '-')
+        else:
+            number = instance['number']
+            address = '54-%d-%d-%d' % (number // 65536 % 256,
+                                       number // 256 % 256, number % 256)
+        return 'ec2-%s.%s.compute.amazonaws.com' % (address, self.region)
+
+    def terminate(self, instance_id, now):
+        instance = self.instances[instance_id]
+        if instance['terminated'] is None:
+            instance['terminated'] = now
+        for load_balancer in self.load_balancers.values():
+            load_balancer['instances'].pop(instance_id, None)
+        for public_ip, address in self.addresses.items():
+            if address['instance_id'] == instance_id:
+                address['instance_id'] = None
+
+    def propagated_tags(self, group):
+        return [
+            (key, value)
+            for key, (value, propagate) in group['tags'].items()
+            if propagate
+        ]
+
+    def reconcile(self, name, now):
+        """
+        Bring a group's instances in line with its capacity, the way Auto
+        Scaling would have done in the background since we last looked.
+        """
+        group = self.groups[name]
+        for action in list(group['scheduled']):
+            if action['start'] <= now:
+                for field in ('desired_capacity', 'min_size', 'max_size'):
+                    if action.get(field) is not None:
+                        group[field] = action[field]
+                group['scheduled'].remove(action)
+                group['capacity_changed'] = action['start']
+
+        live = [
+            instance_id
+            for instance_id in group['instances']
+            if self.instances[instance_id]['terminated'] is None
+        ]
+        while len(live) > group['desired_capacity']:
+            self.terminate(live.pop(), now)
+        if len(live) < group['desired_capacity'] and \
+                now >= group['capacity_changed'] + self.launch_delay:
+            launched = group['capacity_changed'] + self.launch_delay
+            for index in range(group['desired_capacity'] - len(live)):
+                instance_id = self.launch(
+                    zone=group['zones'][(len(live) + index) %
+                                        len(group['zones'])],
+                    now=launched,
+                    tags=self.propagated_tags(group),
+                    group=name,
+                    image_id=self.launch_configurations.get(
+                        group['launch_configuration'], {}).get(
+                            'image_id', 'ami-00000000'))
+                if 'AddToLoadBalancer' not in group['suspended']:
+                    for load_balancer_name in group['load_balancers']:
+                        self.load_balancers[load_balancer_name][
+                            'instances'][instance_id] = launched
+                live.append(instance_id)
+        group['instances'] = live
+
+    # EC2
+
+    def ec2_DescribeInstances(self, params, now):
+        instance_ids = values(params, 'InstanceId')
+        filters = dict(
+            (item['Name'], set(values(item, 'Value')))
+            for item in members(params, 'Filter'))
+        if instance_ids:
+            filters.setdefault('instance-id', set(instance_ids))
+
+        matches = [
+            instance_id
+            for instance_id, instance in self.instances.items()
+            if self.instance_matches(instance_id, instance, filters, now)
+        ]
+        start = int(params.get('NextToken') or 0)
+        page_size = int(params.get('MaxResults') or 1000)
+        page = matches[start:start + page_size]
+        next_token = start + page_size if start + page_size < len(matches) \
+            else None
+        return (
+            '<reservationSet>%s</reservationSet>%s' % (
+                ''.join('<item>%s</item>' % self.reservation_xml(
+                    [instance_id], now) for instance_id in page),
+                element('nextToken', next_token))
+        )
+
+    def instance_matches(self, instance_id, instance, filters, now):
+        for name, accepted in filters.items():
+            if name == 'instance-id':
+                value = instance_id
+            elif name == 'instance-state-name':
+                value = self.instance_state(instance, now)
+            elif name.startswith('tag:'):
+                value = instance['tags'].get(name[4:])
+            else:
+                raise FakeAWSError(
+                    'InvalidParameterValue', 'Unsupported filter %s' % name)
+            if value not in accepted:
+                return False
+        return True
+
+    def reservation_xml(self, instance_ids, now):
+        return (
+            '<reservationId>r-%s</reservationId>'
+            '<ownerId>%s</ownerId><groupSet/>'
+            '<instancesSet>%s</instancesSet>' % (
+                instance_ids[0].split('-')[1], ACCOUNT_ID,
+                ''.join(self.instance_xml(instance_id, now)
+                        for instance_id in instance_ids))
+        )
+
+    def instance_xml(self, instance_id, now):
+        instance = self.instances[instance_id]
+        state = self.instance_state(instance, now)
+        return (
+            '<item>'
+            '<instanceId>%s</instanceId><imageId>%s</imageId>'
+            '<instanceState><code>%d</code><name>%s</name></instanceState>'
+            '<dnsName>%s</dnsName><instanceType>t2.medium</instanceType>'
+            '<launchTime>%s</launchTime>'
+            '<placement><availabilityZone>%s</availabilityZone></placement>'
+            '%s<tagSet>%s</tagSet>'
+            '</item>' % (
+                instance_id, instance['image_id'],
+                INSTANCE_STATE_CODES[state], state,
+                self.dns_name(instance, now),
+                timestamp(instance['launched']), instance['zone'],
+                element('ipAddress', instance['public_ip']),
+                ''.join(
+                    '<item><key>%s</key><value>%s</value></item>' % (
+                        escape(key), escape(value))
+                    for key, value in instance['tags'].items()))
+        )
+
+    def ec2_RunInstances(self, params, now):
+        count = int(params.get('MinCount', 1))
+        zone = params.get('Placement.AvailabilityZone', '%sa' % self.region)
+        instance_ids = [
+            self.launch(zone=zone, now=now, tags={},
+                        image_id=params.get('ImageId'))
+            for _ in range(count)
+        ]
+        # Bake scripts power the instance off once they're done
+        user_data = base64.b64decode(params.get('UserData', ''))
+        check_user_data(user_data)
+        if params.get('InstanceInitiatedShutdownBehavior') == 'stop' and \
+                'shutdown' in user_data:
+            for instance_id in instance_ids:
+                self.instances[instance_id]['stops'] = \
+                    now + self.boot_delay + self.bake_delay
+        return self.reservation_xml(instance_ids, now)
+
+    def ec2_TerminateInstances(self, params, now):
+        instance_ids = values(params, 'InstanceId')
+        for instance_id in instance_ids:
+            self.terminate(instance_id, now)
+        return '<instancesSet>%s</instancesSet>' % ''.join(
+            '<item><instanceId>%s</instanceId></item>' % instance_id
+            for instance_id in instance_ids)
+
+    def ec2_CreateImage(self, params, now):
+        instance = self.instances.get(params.get('InstanceId'))
+        if instance is None:
+            raise FakeAWSError('InvalidInstanceID.NotFound')
+        name = params.get('Name')
+        if any(image['name'] == name for image in self.images.values()):
+            raise FakeAWSError(
+                'InvalidAMIName.Duplicate', 'AMI name %s is already in use' %
+                name)
+        image_id = self.new_id('ami')
+        self.images[image_id] = {
+            'name': name,
+            'created': now,
+            'tags': {},
+        }
+        return '<imageId>%s</imageId>' % image_id
+
+    def ec2_DescribeImages(self, params, now):
+        image_ids = values(params, 'ImageId')
+        filters = dict(
+            (item['Name'], set(values(item, 'Value')))
+            for item in members(params, 'Filter'))
+        images = []
+        for image_id, image in self.images.items():
+            if image_ids and image_id not in image_ids:
+                continue
+            state = self.image_state(image, now)
+            if 'state' in filters and state not in filters['state']:
+                continue
+            if not all(image['tags'].get(name[4:]) in accepted
+                       for name, accepted in filters.items()
+                       if name.startswith('tag:')):
+                continue
+            images.append(
+                '<item><imageId>%s</imageId><imageState>%s</imageState>'
+                '<name>%s</name><imageOwnerId>%s</imageOwnerId>'
+                '<tagSet>%s</tagSet></item>' % (
+                    image_id, state, escape(image['name']), ACCOUNT_ID,
+                    ''.join(
+                        '<item><key>%s</key><value>%s</value></item>' % (
+                            escape(key), escape(value))
+                        for key, value in image['tags'].items())))
+        return '<imagesSet>%s</imagesSet>' % ''.join(images)
+
+    def image_state(self, image, now):
+        if now < image['created'] + self.image_delay:
+            return 'pending'
+        return 'available'
+
+    def ec2_CreateTags(self, params, now):
+        tags = [
+            (item['Key'], item.get('Value', ''))
+            for item in members(params, 'Tag')
+        ]
+        for resource_id in values(params, 'ResourceId'):
+            resource = self.instances.get(resource_id) or \
+                self.volumes.get(resource_id) or \
+                self.images.get(resource_id)
+            if resource is None:
+                raise FakeAWSError(
+                    'InvalidID', 'The ID %s is not valid' % resource_id)
+            resource['tags'].update(tags)
+        return '<return>true</return>'
+
+    def ec2_DescribeSecurityGroups(self, params, now):
+        names = values(params, 'GroupName') or list(self.security_groups)
+        for name in names:
+            if name not in self.security_groups:
+                raise FakeAWSError(
+                    'InvalidGroup.NotFound',
+                    "The security group '%s' does not exist" % name)
+        return '<securityGroupInfo>%s</securityGroupInfo>' % ''.join(
+            '<item><ownerId>%s</ownerId><groupId>%s</groupId>'
+            '<groupName>%s</groupName><groupDescription/></item>' % (
+                ACCOUNT_ID, self.security_groups[name], escape(name))
+            for name in names)
+
+    def ec2_DescribeAddresses(self, params, now):
+        return '<addressesSet>%s</addressesSet>' % ''.join(
+            '<item><publicIp>%s</publicIp><domain>standard</domain>'
+            '%s</item>' % (public_ip,
+                           element('instanceId', address['instance_id']))
+            for public_ip, address in self.addresses.items())
+
+    def ec2_AssociateAddress(self, params, now):
+        public_ip = params.get('PublicIp')
+        instance_id = params.get('InstanceId')
+        if public_ip not in self.addresses:
+            raise FakeAWSError('InvalidAddress.NotFound')
+        if instance_id not in self.instances:
+            raise FakeAWSError('InvalidInstanceID.NotFound')
+        self.addresses[public_ip]['instance_id'] = instance_id
+        self.instances[instance_id]['public_ip'] = public_ip
+        return '<return>true</return>'
+
+    def ec2_DescribeVolumes(self, params, now):
+        volume_ids = values(params, 'VolumeId')
+        filters = dict(
+            (item['Name'], set(values(item, 'Value')))
+            for item in members(params, 'Filter'))
+        volumes = [
+            (volume_id, volume)
+            for volume_id, volume in self.volumes.items()
+            if (not volume_ids or volume_id in volume_ids) and all(
+                volume['tags'].get(name[4:]) in accepted
+                for name, accepted in filters.items()
+                if name.startswith('tag:'))
+        ]
+        return '<volumeSet>%s</volumeSet>' % ''.join(
+            '<item>%s</item>' % self.volume_xml(volume_id, volume, now)
+            for volume_id, volume in volumes)
+
+    def volume_xml(self, volume_id, volume, now):
+        if volume['instance_id']:
+            status = 'in-use'
+        elif now < volume['created'] + self.volume_delay:
+            status = 'creating'
+        else:
+            status = 'available'
+        return (
+            '<volumeId>%s</volumeId><size>%s</size>'
+            '<availabilityZone>%s</availabilityZone><status>%s</status>'
+            '<createTime>%s</createTime><volumeType>%s</volumeType>' % (
+                volume_id, volume['size'], volume['zone'], status,
+                timestamp(volume['created']), volume['type'])
+        )
+
+    def ec2_CreateVolume(self, params, now):
+        volume_id = self.new_id('vol')
+        self.volumes[volume_id] = {
+            'size': params.get('Size'),
+            'zone': params.get('AvailabilityZone'),
+            'type': params.get('VolumeType', 'standard'),
+            'created': now,
+            'instance_id': None,
+            'tags': {},
+        }
+        return self.volume_xml(volume_id, self.volumes[volume_id], now)
+
+    def ec2_AttachVolume(self, params, now):
+        volume = self.volumes.get(params.get('VolumeId'))
+        if volume is None:
+            raise FakeAWSError('InvalidVolume.NotFound')
+        volume['instance_id'] = params.get('InstanceId')
+        return '<status>attaching</status>'
+
+    # ELB
+
+    def load_balancer(self, name):
+        if name not in self.load_balancers:
+            raise FakeAWSError(
+                'LoadBalancerNotFound',
+                'There is no ACTIVE Load Balancer named \'%s\'' % name)
+        return self.load_balancers[name]
+
+    def elb_CreateLoadBalancer(self, params, now):
+        name = params['LoadBalancerName']
+        if name not in self.load_balancers:
+            self.load_balancers[name] = {
+                'dns_name': '%s-%d.%s.elb.amazonaws.com' % (
+                    name, next(self.ids), self.region),
+                'zones': values(params, 'AvailabilityZones.member'),
+                'listeners': members(params, 'Listeners.member'),
+                'health_check': {},
+                'instances': collections.OrderedDict(),
+                'tags': collections.OrderedDict(),
+            }
+        return element('DNSName', self.load_balancers[name]['dns_name'])
+
+    def elb_DescribeLoadBalancers(self, params, now):
+        names = values(params, 'LoadBalancerNames.member') or \
+            list(self.load_balancers)
+        return '<LoadBalancerDescriptions>%s</LoadBalancerDescriptions>' % \
+            ''.join(self.load_balancer_xml(name) for name in names)
+
+    def load_balancer_xml(self, name):
+        load_balancer = self.load_balancer(name)
+        return (
+            '<member><LoadBalancerName>%s</LoadBalancerName>'
+            '<DNSName>%s</DNSName>'
+            '<CanonicalHostedZoneName>%s</CanonicalHostedZoneName>'
+            '<CanonicalHostedZoneNameID>%s</CanonicalHostedZoneNameID>'
+            '<AvailabilityZones>%s</AvailabilityZones>'
+            '<Instances>%s</Instances>'
+            '<ListenerDescriptions/><Policies/><BackendServerDescriptions/>'
+            '<Scheme>internet-facing</Scheme></member>' % (
+                name, load_balancer['dns_name'], load_balancer['dns_name'],
+                ELB_HOSTED_ZONE_ID,
+                ''.join(element('member', zone)
+                        for zone in load_balancer['zones']),
+                ''.join(
+                    '<member><InstanceId>%s</InstanceId></member>' % (
+                        instance_id)
+                    for instance_id in load_balancer['instances']))
+        )
+
+    def elb_ConfigureHealthCheck(self, params, now):
+        load_balancer = self.load_balancer(params['LoadBalancerName'])
+        load_balancer['health_check'] = dict(
+            (key.split('.', 1)[1], value)
+            for key, value in params.items()
+            if key.startswith('HealthCheck.'))
+        return '<HealthCheck>%s</HealthCheck>' % ''.join(
+            element(key, value)
+            for key, value in sorted(load_balancer['health_check'].items()))
+
+    def elb_RegisterInstancesWithLoadBalancer(self, params, now):
+        load_balancer = self.load_balancer(params['LoadBalancerName'])
+        for item in members(params, 'Instances.member'):
+            if item['InstanceId'] not in self.instances:
+                raise FakeAWSError('InvalidInstance')
+            load_balancer['instances'].setdefault(item['InstanceId'], now)
+        return self.instance_ids_xml(load_balancer)
+
+    def elb_DeregisterInstancesFromLoadBalancer(self, params, now):
+        load_balancer = self.load_balancer(params['LoadBalancerName'])
+        for item in members(params, 'Instances.member'):
+            load_balancer['instances'].pop(item['InstanceId'], None)
+        return self.instance_ids_xml(load_balancer)
+
+    def instance_ids_xml(self, load_balancer):
+        return '<Instances>%s</Instances>' % ''.join(
+            '<member><InstanceId>%s</InstanceId></member>' % instance_id
+            for instance_id in load_balancer['instances'])
+
+    def elb_DescribeInstanceHealth(self, params, now):
+        load_balancer = self.load_balancer(params['LoadBalancerName'])
+        instance_ids = [
+            item['InstanceId']
+            for item in members(params, 'Instances.member')
+        ] or list(load_balancer['instances'])
+        states = []
+        for instance_id in instance_ids:
+            registered = load_balancer['instances'].get(instance_id)
+            instance = self.instances.get(instance_id)
+            if registered is None or instance is None:
+                state, reason = 'OutOfService', 'ELB'
+            elif self.instance_state(instance, now) != 'running' or \
+                    now < max(registered, instance['launched'] +
+                              self.boot_delay) + self.health_delay:
+                state, reason = 'OutOfService', 'Instance'
+            else:
+                state, reason = 'InService', 'N/A'
+            states.append(
+                '<member><InstanceId>%s</InstanceId><State>%s</State>'
+                '<ReasonCode>%s</ReasonCode><Description/></member>' % (
+                    instance_id, state, reason))
+        return '<InstanceStates>%s</InstanceStates>' % ''.join(states)
+
+    def elb_AddTags(self, params, now):
+        tags = [
+            (item['Key'], item.get('Value', ''))
+            for item in members(params, 'Tags.member')
+        ]
+        for name in values(params, 'LoadBalancerNames.member'):
+            self.load_balancer(name)['tags'].update(tags)
+        return ''
+
+    def elb_DescribeTags(self, params, now):
+        names = values(params, 'LoadBalancerNames.member')
+        if len(names) > 20:
+            raise FakeAWSError('ValidationError',
+                               'At most 20 load balancer names are allowed')
+        return '<TagDescriptions>%s</TagDescriptions>' % ''.join(
+            '<member><LoadBalancerName>%s</LoadBalancerName>'
+            '<Tags>%s</Tags></member>' % (name, ''.join(
+                # Value before Key, like AWS's own example response
+                '<member><Value>%s</Value><Key>%s</Key></member>' % (
+                    escape(value), escape(key))
+                for key, value in self.load_balancer(name)['tags'].items()))
+            for name in names)
+
+    # Auto Scaling
+
+    def group(self, name, now):
+        if name not in self.groups:
+            raise FakeAWSError(
+                'ValidationError', 'AutoScalingGroup name not found - %s' % (
+                    name))
+        self.reconcile(name, now)
+        return self.groups[name]
+
+    def autoscale_CreateLaunchConfiguration(self, params, now):
+        name = params['LaunchConfigurationName']
+        if name in self.launch_configurations:
+            raise FakeAWSError(
+                'AlreadyExists',
+                'Launch Configuration by this name already exists - %s' % (
+                    name))
+        user_data = base64.b64decode(params.get('UserData', ''))
+        check_user_data(user_data)
+        self.launch_configurations[name] = {
+            'image_id': params.get('ImageId'),
+            'instance_type': params.get('InstanceType'),
+            'key_name': params.get('KeyName'),
+            'user_data': user_data,
+            'security_groups': values(params, 'SecurityGroups.member'),
+            'instance_profile_name': params.get('IamInstanceProfile'),
+            'created': now,
+        }
+        return ''
+
+    def autoscale_DescribeLaunchConfigurations(self, params, now):
+        names = values(params, 'LaunchConfigurationNames.member') or \
+            list(self.launch_configurations)
+        return '<LaunchConfigurations>%s</LaunchConfigurations>' % ''.join(
+            '<member><LaunchConfigurationName>%s</LaunchConfigurationName>'
+            '<ImageId>%s</ImageId><InstanceType>%s</InstanceType>'
+            '<UserData>%s</UserData><CreatedTime>%s</CreatedTime>'
+            '<SecurityGroups/><BlockDeviceMappings/></member>' % (
+                name,
+                launch_configuration['image_id'],
+                launch_configuration.get('instance_type') or '',
+                base64.b64encode(launch_configuration.get('user_data', '')),
+                timestamp(launch_configuration['created']))
+            for name, launch_configuration
+            in self.launch_configurations.items()
+            if name in names)
+
+    def autoscale_DeleteLaunchConfiguration(self, params, now):
+        name = params['LaunchConfigurationName']
+        if name not in self.launch_configurations:
+            raise FakeAWSError('ValidationError',
+                               'Launch configuration name not found')
+        if any(group['launch_configuration'] == name
+               for group in self.groups.values()):
+            raise FakeAWSError(
+                'ResourceInUse',
+                'Cannot delete launch configuration %s because it is '
+                'attached to AutoScalingGroup' % name)
+        del self.launch_configurations[name]
+        return ''
+
+    def autoscale_CreateAutoScalingGroup(self, params, now):
+        name = params['AutoScalingGroupName']
+        if name in self.groups:
+            raise FakeAWSError(
+                'AlreadyExists', 'AutoScalingGroup by this name already '
+                'exists - %s' % name)
+        if params.get('LaunchConfigurationName') not in \
+                self.launch_configurations:
+            raise FakeAWSError('ValidationError',
+                               'Launch configuration name not found')
+        self.groups[name] = {
+            'launch_configuration': params['LaunchConfigurationName'],
+            'min_size': int(params['MinSize']),
+            'max_size': int(params['MaxSize']),
+            'desired_capacity': int(
+                params.get('DesiredCapacity', params['MinSize'])),
+            'zones': values(params, 'AvailabilityZones.member'),
+            'load_balancers': values(params, 'LoadBalancerNames.member'),
+            'tags': collections.OrderedDict(
+                (item['Key'], (item.get('Value', ''),
+                               item.get('PropagateAtLaunch') == 'true'))
+                for item in members(params, 'Tags.member')),
+            'suspended': set(),
+            'instances': [],
+            'scheduled': [],
+            'capacity_changed': now,
+            'created': now,
+        }
+        return ''
+
+    def autoscale_UpdateAutoScalingGroup(self, params, now):
+        group = self.group(params['AutoScalingGroupName'], now)
+        for field, param in (('min_size', 'MinSize'),
+                             ('max_size', 'MaxSize'),
+                             ('desired_capacity', 'DesiredCapacity')):
+            if param in params:
+                group[field] = int(params[param])
+        if 'LaunchConfigurationName' in params:
+            group['launch_configuration'] = params['LaunchConfigurationName']
+        group['desired_capacity'] = min(
+            max(group['desired_capacity'], group['min_size']),
+            group['max_size'])
+        group['capacity_changed'] = now
+        self.reconcile(params['AutoScalingGroupName'], now)
+        return ''
+
+    def autoscale_SetDesiredCapacity(self, params, now):
+        group = self.group(params['AutoScalingGroupName'], now)
+        group['desired_capacity'] = int(params['DesiredCapacity'])
+        group['capacity_changed'] = now
+        return ''
+
+    def autoscale_DeleteAutoScalingGroup(self, params, now):
+        name = params['AutoScalingGroupName']
+        group = self.group(name, now)
+        live = [
+            instance_id
+            for instance_id in group['instances']
+            if self.instances[instance_id]['terminated'] is None
+        ]
+        if live and params.get('ForceDelete') != 'true':
+            raise FakeAWSError(
+                'ResourceInUse',
+                'You cannot delete an AutoScalingGroup while there are '
+                'instances still in the group.')
+        for instance_id in live:
+            self.terminate(instance_id, now)
+        del self.groups[name]
+        for key in [key for key in self.policies if key[0] == name]:
+            del self.policies[key]
+        return ''
+
+    def autoscale_DescribeAutoScalingGroups(self, params, now):
+        names = values(params, 'AutoScalingGroupNames.member') or \
+            list(self.groups)
+        names = [name for name in names if name in self.groups]
+        start = int(params.get('NextToken') or 0)
+        page_size = min(int(params.get('MaxRecords') or 50), 100)
+        page = names[start:start + page_size]
+        next_token = start + page_size if start + page_size < len(names) \
+            else None
+        return '<AutoScalingGroups>%s</AutoScalingGroups>%s' % (
+            ''.join(self.group_xml(name, now) for name in page),
+            element('NextToken', next_token))
+
+    def group_xml(self, name, now):
+        group = self.group(name, now)
+        return (
+            '<member><AutoScalingGroupName>%s</AutoScalingGroupName>'
+            '<AutoScalingGroupARN>%s</AutoScalingGroupARN>'
+            '<LaunchConfigurationName>%s</LaunchConfigurationName>'
+            '<MinSize>%d</MinSize><MaxSize>%d</MaxSize>'
+            '<DesiredCapacity>%d</DesiredCapacity>'
+            '<DefaultCooldown>300</DefaultCooldown>'
+            '<CreatedTime>%s</CreatedTime>'
+            '<AvailabilityZones>%s</AvailabilityZones>'
+            '<LoadBalancerNames>%s</LoadBalancerNames>'
+            '<HealthCheckType>EC2</HealthCheckType>'
+            '<Instances>%s</Instances>'
+            '<SuspendedProcesses>%s</SuspendedProcesses>'
+            '<Tags>%s</Tags></member>' % (
+                name,
+                'arn:aws:autoscaling:%s:%s:autoScalingGroup:%s' % (
+                    self.region, ACCOUNT_ID, name),
+                group['launch_configuration'],
+                group['min_size'], group['max_size'],
+                group['desired_capacity'],
+                timestamp(group['created']),
+                ''.join(element('member', zone) for zone in group['zones']),
+                ''.join(element('member', load_balancer_name)
+                        for load_balancer_name in group['load_balancers']),
+                ''.join(
+                    self.group_instance_xml(instance_id, group, now)
+                    for instance_id in group['instances']),
+                ''.join(
+                    '<member><ProcessName>%s</ProcessName>'
+                    '<SuspensionReason/></member>' % process
+                    for process in sorted(group['suspended'])),
+                ''.join(
+                    '<member><ResourceId>%s</ResourceId>'
+                    '<ResourceType>auto-scaling-group</ResourceType>'
+                    '<Key>%s</Key><Value>%s</Value>'
+                    '<PropagateAtLaunch>%s</PropagateAtLaunch></member>' % (
+                        name, escape(key), escape(value),
+                        'true' if propagate else 'false')
+                    for key, (value, propagate) in group['tags'].items()))
+        )
+
+    def group_instance_xml(self, instance_id, group, now):
+        instance = self.instances[instance_id]
+        state = self.instance_state(instance, now)
+        return (
+            '<member><InstanceId>%s</InstanceId>'
+            '<AvailabilityZone>%s</AvailabilityZone>'
+            '<LifecycleState>%s</LifecycleState>'
+            '<HealthStatus>Healthy</HealthStatus>'
+            '<LaunchConfigurationName>%s</LaunchConfigurationName>'
+            '</member>' % (
+                instance_id, instance['zone'],
+                'InService' if state == 'running' else 'Pending',
+                group['launch_configuration'])
+        )
+
+    def autoscale_SuspendProcesses(self, params, now):
+        group = self.group(params['AutoScalingGroupName'], now)
+        group['suspended'].update(
+            values(params, 'ScalingProcesses.member'))
+        return ''
+
+    def autoscale_ResumeProcesses(self, params, now):
+        group = self.group(params['AutoScalingGroupName'], now)
+        group['suspended'].difference_update(
+            values(params, 'ScalingProcesses.member'))
+        return ''
+
+    def autoscale_CreateOrUpdateTags(self, params, now):
+        for item in members(params, 'Tags.member'):
+            group = self.group(item['ResourceId'], now)
+            group['tags'][item['Key']] = (
+                item.get('Value', ''), item.get('PropagateAtLaunch') == 'true')
+        return ''
+
+    def autoscale_PutScalingPolicy(self, params, now):
+        group_name = params['AutoScalingGroupName']
+        self.group(group_name, now)
+        key = (group_name, params['PolicyName'])
+        if key not in self.policies:
+            self.policies[key] = {
+                'arn': 'arn:aws:autoscaling:%s:%s:scalingPolicy:%s:'
+                       'autoScalingGroupName/%s:policyName/%s' % (
+                           self.region, ACCOUNT_ID, uuid.uuid4(),
+                           group_name, params['PolicyName']),
+            }
+        self.policies[key].update({
+            'adjustment_type': params.get('AdjustmentType'),
+            'scaling_adjustment': params.get('ScalingAdjustment'),
+            'cooldown': params.get('Cooldown'),
+        })
+        return element('PolicyARN', self.policies[key]['arn'])
+
+    def autoscale_DescribePolicies(self, params, now):
+        group_name = params.get('AutoScalingGroupName')
+        names = values(params, 'PolicyNames.member')
+        return '<ScalingPolicies>%s</ScalingPolicies>' % ''.join(
+            '<member><PolicyName>%s</PolicyName><PolicyARN>%s</PolicyARN>'
+            '<AutoScalingGroupName>%s</AutoScalingGroupName>'
+            '<AdjustmentType>%s</AdjustmentType>'
+            '<ScalingAdjustment>%s</ScalingAdjustment>'
+            '<Cooldown>%s</Cooldown><Alarms/></member>' % (
+                name, policy['arn'], policy_group,
+                policy['adjustment_type'], policy['scaling_adjustment'],
+                policy['cooldown'])
+            for (policy_group, name), policy in self.policies.items()
+            if (not group_name or policy_group == group_name)
+            and (not names or name in names))
+
+    def autoscale_PutScheduledUpdateGroupAction(self, params, now):
+        group = self.group(params['AutoScalingGroupName'], now)
+        group['scheduled'] = [
+            action for action in group['scheduled']
+            if action['name'] != params['ScheduledActionName']
+        ] + [{
+            'name': params['ScheduledActionName'],
+            'start': parse_timestamp(params.get('StartTime')) or now,
+            'desired_capacity': integer(params.get('DesiredCapacity')),
+            'min_size': integer(params.get('MinSize')),
+            'max_size': integer(params.get('MaxSize')),
+        }]
+        return ''
+
+    def autoscale_DeleteScheduledAction(self, params, now):
+        group = self.group(params['AutoScalingGroupName'], now)
+        names = [action['name'] for action in group['scheduled']]
+        if params['ScheduledActionName'] not in names:
+            raise FakeAWSError('ValidationError',
+                               'Scheduled action name not found')
+        group['scheduled'] = [
+            action for action in group['scheduled']
+            if action['name'] != params['ScheduledActionName']
+        ]
+        return ''
+
+    # CloudWatch
+
+    def cloudwatch_PutMetricAlarm(self, params, now):
+        self.alarms[params['AlarmName']] = params
+        return ''
+
+    # Route53
+
+    def route53(self, method, path, query, body, now):
+        parts = path.strip('/').split('/')[1:]
+        if method == 'GET' and parts == ['hostedzone']:
+            return 200, {}, self.route53_hosted_zones()
+        if method == 'POST' and len(parts) == 3 and parts[2] == 'rrset':
+            return 200, {}, self.route53_change(parts[1], body, now)
+        if method == 'GET' and len(parts) == 3 and parts[2] == 'rrset':
+            return 200, {}, self.route53_record_sets(parts[1])
+        if method == 'GET' and len(parts) == 2 and parts[0] == 'change':
+            return 200, {}, self.route53_get_change(parts[1], now)
+        raise FakeAWSError('InvalidInput', 'Unsupported request %s %s' % (
+            method, path))
+
+    def route53_zone(self, zone_id):
+        if zone_id not in self.zones:
+            raise FakeAWSError('NoSuchHostedZone', status=404)
+        return self.zones[zone_id]
+
+    def route53_hosted_zones(self):
+        return route53_response('ListHostedZonesResponse', (
+            '<HostedZones>%s</HostedZones><IsTruncated>false</IsTruncated>'
+            '<MaxItems>100</MaxItems>' % ''.join(
+                '<HostedZone><Id>/hostedzone/%s</Id><Name>%s</Name>'
+                '<CallerReference>%s</CallerReference><Config/>'
+                '<ResourceRecordSetCount>%d</ResourceRecordSetCount>'
+                '</HostedZone>' % (zone_id, zone['name'], zone_id,
+                                   len(zone['records']))
+                for zone_id, zone in self.zones.items())))
+
+    def route53_change(self, zone_id, body, now):
+        zone = self.route53_zone(zone_id)
+        changes = ElementTree.fromstring(body).iter(
+            '{%s}Change' % ROUTE53_NAMESPACE)
+        for change in changes:
+            action = child_text(change, 'Action')
+            record_set = change.find(
+                '{%s}ResourceRecordSet' % ROUTE53_NAMESPACE)
+            record = {
+                'name': child_text(record_set, 'Name'),
+                'type': child_text(record_set, 'Type'),
+                'ttl': child_text(record_set, 'TTL'),
+                'values': [
+                    value.text
+                    for value in record_set.iter(
+                        '{%s}Value' % ROUTE53_NAMESPACE)
+                ],
+                'alias': None,
+            }
+            alias = record_set.find('{%s}AliasTarget' % ROUTE53_NAMESPACE)
+            if alias is not None:
+                record['alias'] = (child_text(alias, 'HostedZoneId'),
+                                   child_text(alias, 'DNSName'))
+            key = (record['name'], record['type'])
+            if action == 'DELETE':
+                zone['records'].pop(key, None)
+            elif action == 'CREATE' and key in zone['records']:
+                raise FakeAWSError('InvalidChangeBatch',
+                                   '%s %s already exists' % key)
+            else:
+                zone['records'][key] = record
+
+        change_id = 'C%012d' % next(self.ids)
+        self.changes[change_id] = now
+        return route53_response(
+            'ChangeResourceRecordSetsResponse',
+            self.change_info_xml(change_id, now))
+
+    def route53_record_sets(self, zone_id):
+        zone = self.route53_zone(zone_id)
+        return route53_response('ListResourceRecordSetsResponse', (
+            '<ResourceRecordSets>%s</ResourceRecordSets>'
+            '<IsTruncated>false</IsTruncated><MaxItems>100</MaxItems>' % (
+                ''.join(
+                    '<ResourceRecordSet><Name>%s</Name><Type>%s</Type>'
+                    '%s</ResourceRecordSet>' % (
+                        record['name'], record['type'],
+                        '<AliasTarget><HostedZoneId>%s</HostedZoneId>'
+                        '<DNSName>%s</DNSName><EvaluateTargetHealth>false'
+                        '</EvaluateTargetHealth></AliasTarget>' % (
+                            record['alias'])
+                        if record['alias'] else
+                        '<TTL>%s</TTL><ResourceRecords>%s</ResourceRecords>'
+                        % (record['ttl'], ''.join(
+                            '<ResourceRecord><Value>%s</Value>'
+                            '</ResourceRecord>' % escape(value)
+                            for value in record['values'])))
+                    for record in zone['records'].values()))))
+
+    def route53_get_change(self, change_id, now):
+        if change_id not in self.changes:
+            raise FakeAWSError('NoSuchChange', status=404)
+        return route53_response(
+            'GetChangeResponse', self.change_info_xml(change_id, now))
+
+    def change_info_xml(self, change_id, now):
+        submitted = self.changes[change_id]
+        return (
+            '<ChangeInfo><Id>/change/%s</Id><Status>%s</Status>'
+            '<SubmittedAt>%s</SubmittedAt></ChangeInfo>' % (
+                change_id,
+                'INSYNC' if now >= submitted + self.sync_delay
+                else 'PENDING',
+                timestamp(submitted))
+        )
+
+    # S3
+
+    def s3(self, method, path, query, headers, body):
+        bucket_name, _, key_name = path.lstrip('/').partition('/')
+        key_name = urlparse.unquote(key_name)
+        if bucket_name not in self.buckets:
+            raise FakeAWSError('NoSuchBucket', status=404)
+        bucket = self.buckets[bucket_name]
+
+        if not key_name:
+            if method == 'HEAD':
+                return 200, {}, ''
+            if method == 'GET':
+                params = dict(urlparse.parse_qsl(query))
+                return 200, {}, self.s3_list(
+                    bucket_name, bucket, params.get('prefix', ''))
+        elif method == 'PUT':
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            bucket[key_name] = {'body': body, 'etag': etag,
+                                'modified': time.time()}
+            return 200, {'ETag': etag}, ''
+        elif key_name in bucket and method in ('GET', 'HEAD'):
+            key = bucket[key_name]
+            return 200, {'ETag': key['etag']}, \
+                key['body'] if method == 'GET' else ''
+        elif method in ('GET', 'HEAD'):
+            raise FakeAWSError('NoSuchKey', status=404)
+        raise FakeAWSError('NotImplemented', status=501)
+
+    def s3_list(self, bucket_name, bucket, prefix):
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns='
+            '"http://s3.amazonaws.com/doc/2006-03-01/">'
+            '<Name>%s</Name><Prefix>%s</Prefix><Marker/>'
+            '<MaxKeys>1000</MaxKeys><IsTruncated>false</IsTruncated>'
+            '%s</ListBucketResult>' % (
+                bucket_name, escape(prefix), ''.join(
+                    '<Contents><Key>%s</Key>'
+                    '<LastModified>%s</LastModified><ETag>%s</ETag>'
+                    '<Size>%d</Size><StorageClass>STANDARD</StorageClass>'
+                    '</Contents>' % (
+                        escape(key_name), timestamp(key['modified']),
+                        escape(key['etag']), len(key['body']))
+                    for key_name, key in bucket.items()
+                    if key_name.startswith(prefix)))
+        )
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        path, _, query = self.path.partition('?')
+        length = int(self.headers.get('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        status, headers, response = self.server.backend.handle(
+            service=self.server.service,
+            method=self.command,
+            path=path,
+            query=query,
+            headers=self.headers,
+            body=body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(response)
+
+    do_GET = do_POST = do_PUT = do_HEAD = do_DELETE = respond
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RemoteResult(str):
+    """
+    What fabric's ``run`` returns: the command's output with its exit code.
+    """
+    return_code = 0
+    succeeded = True
+    failed = False
+
+
+class FakeHost(object):
+    """
+    Stands in for fabric's ``put`` and ``run`` against a host we'd normally
+    SSH to, like the nagios master, recording the commands it was sent.
+    """
+
+    def __init__(self, latency=0.05):
+        self.latency = latency
+        self.commands = []
+
+    def put(self, local_path, remote_path, *args, **kwargs):
+        time.sleep(self.latency)
+        self.commands.append(('put', remote_path))
+        return [remote_path]
+
+    def run(self, command, *args, **kwargs):
+        time.sleep(self.latency)
+        self.commands.append(('run', command))
+        return RemoteResult('')
+
+
+class FakeSite(object):
+    """
+    Stands in for ``urlopen`` against the app behind the QA URLs. Each
+    host's first ``cold_requests`` requests take ``cold_latency`` seconds,
+    as a fresh instance's would, and the rest take ``latency``.
+    """
+
+    def __init__(self, latency=0.02, cold_latency=0.5, cold_requests=8):
+        self.latency = latency
+        self.cold_latency = cold_latency
+        self.cold_requests = cold_requests
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+
+    def urlopen(self, request, timeout=None):
+        with self.lock:
+            self.requests[request.get_host()] += 1
+            cold = self.requests[request.get_host()] <= self.cold_requests
+        time.sleep(self.cold_latency if cold else self.latency)
+        return FakeResponse()
+
+
+class FakeResponse(object):
+
+    def read(self):
+        return ''
+
+    def close(self):
+        pass
+
+
+def connect(service_name, region, endpoints):
+    """
+    A boto connection for ``service_name`` (e.g. ``boto.ec2.elb``) that
+    talks to the fake backend listening on ``endpoints``.
+    """
+    service = service_name.split('.')[-1]
+    options = {
+        'aws_access_key_id': 'fake',
+        'aws_secret_access_key': 'fake',
+        'is_secure': False,
+        'port': endpoints[service],
+    }
+    if service == 'route53':
+        # Route53Connection always asks for HTTPS, so switch it back
+        is_secure = options.pop('is_secure')
+        connection = boto.route53.Route53Connection(
+            host='127.0.0.1', **options)
+        connection.is_secure = is_secure
+        connection.protocol = 'http'
+        return connection
+    if service == 's3':
+        return boto.s3.connection.S3Connection(
+            host='127.0.0.1',
+            calling_format=boto.s3.connection.OrdinaryCallingFormat(),
+            **options)
+    connection_class = {
+        'ec2': boto.ec2.EC2Connection,
+        'elb': boto.ec2.elb.ELBConnection,
+        'autoscale': boto.ec2.autoscale.AutoScaleConnection,
+        'cloudwatch': boto.ec2.cloudwatch.CloudWatchConnection,
+    }[service]
+    return connection_class(
+        region=RegionInfo(name=region, endpoint='127.0.0.1'), **options)
+
+
+ROUTE53_NAMESPACE = 'https://route53.amazonaws.com/doc/2013-04-01/'
+
+QUERY_NAMESPACES = {
+    'ec2': 'http://ec2.amazonaws.com/doc/2014-10-01/',
+    'elb': 'http://elasticloadbalancing.amazonaws.com/doc/2012-06-01/',
+    'autoscale': 'http://autoscaling.amazonaws.com/doc/2011-01-01/',
+    'cloudwatch': 'http://monitoring.amazonaws.com/doc/2010-08-01/',
+}
+
+
+def query_response(service, action, result):
+    request_id = uuid.uuid4()
+    if service == 'ec2':
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<%sResponse xmlns="%s"><requestId>%s</requestId>%s'
+            '</%sResponse>' % (action, QUERY_NAMESPACES[service], request_id,
+                               result, action)
+        )
+    return (
+        '<%sResponse xmlns="%s"><%sResult>%s</%sResult>'
+        '<ResponseMetadata><RequestId>%s</RequestId></ResponseMetadata>'
+        '</%sResponse>' % (action, QUERY_NAMESPACES[service], action, result,
+                           action, request_id, action)
+    )
+
+
+def check_user_data(user_data):
+    """
+    AWS takes any user data, but instances whose script doesn't parse never
+    finish booting. We check it with ``sh -n`` so a deploy that would ship
+    one fails here instead.
+    """
+    if not user_data:
+        return
+    check = subprocess.Popen(['sh', '-n'], stdin=subprocess.PIPE,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = check.communicate(user_data)[0]
+    if check.returncode != 0:
+        raise FakeAWSError(
+            'InvalidParameterValue',
+            'User data is not a valid shell script: %s' % output.strip())
+
+
+def error_response(service, error):
+    request_id = uuid.uuid4()
+    if service == 'ec2':
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Response><Errors><Error><Code>%s</Code><Message>%s</Message>'
+            '</Error></Errors><RequestID>%s</RequestID></Response>' % (
+                error.code, escape(error.message), request_id)
+        )
+    if service == 's3':
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Error><Code>%s</Code><Message>%s</Message>'
+            '<RequestId>%s</RequestId></Error>' % (
+                error.code, escape(error.message), request_id)
+        )
+    return (
+        '<ErrorResponse><Error><Type>Sender</Type><Code>%s</Code>'
+        '<Message>%s</Message></Error><RequestId>%s</RequestId>'
+        '</ErrorResponse>' % (error.code, escape(error.message), request_id)
+    )
+
+
+def route53_response(name, body):
+    return '<?xml version="1.0" encoding="UTF-8"?><%s xmlns="%s">%s</%s>' % (
+        name, ROUTE53_NAMESPACE, body, name)
+
+
+def element(name, value):
+    if value is None:
+        return ''
+    return '<%s>%s</%s>' % (name, escape(str(value)), name)
+
+
+def child_text(node, name):
+    child = node.find('{%s}%s' % (ROUTE53_NAMESPACE, name))
+    return child.text if child is not None else None
+
+
+def members(params, prefix):
+    """
+    The structures of a list parameter, e.g. ``Tags.member.1.Key`` and
+    ``Tags.member.1.Value`` become ``[{'Key': ..., 'Value': ...}]``.
+    """
+    items = {}
+    for key, value in params.items():
+        if not key.startswith(prefix + '.'):
+            continue
+        index, _, field = key[len(prefix) + 1:].partition('.')
+        if index.isdigit():
+            items.setdefault(int(index), {})[field] = value
+    return [items[index] for index in sorted(items)]
+
+
+def values(params, prefix):
+    return [item[''] for item in members(params, prefix) if '' in item]
+
+
+def integer(value):
+    return int(value) if value is not None else None
+
+
+def timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(seconds))
+
+
+TIMESTAMP_PATTERN = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)')
+
+
+def parse_timestamp(value):
+    """
+    boto sends scheduled action times as naive local ``isoformat()``s.
+    """
+    match = TIMESTAMP_PATTERN.match(value or '')
+    if not match:
+        return None
+    return time.mktime(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+
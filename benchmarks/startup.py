@@ -0,0 +1,89 @@
+"""
+Measures what loading the fabfile costs before a task runs.
+
+    python benchmarks/startup.py
+
+Each scenario runs in a fresh process and times a cold import of
+templates/aws/fabfile.py and the tangentdeployer modules it pulls in, then
+building ``env.connections`` and the services a task would use: nothing
+(e.g. ``fab --list``), ec2 only, and every service, which is what every
+invocation paid before connections and boto imports were made lazy. Fabric
+itself is imported before the clock starts, ``fab`` always pays for it. No
+requests are sent; connecting only imports boto modules and resolves
+credentials, so dummy credentials are used if none are configured.
+"""
+import os
+import imp
+import sys
+import time
+import types
+import subprocess
+
+from fabric.api import env
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+FABFILE = os.path.join(ROOT, 'templates', 'aws', 'fabfile.py')
+
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+fabconfig = types.ModuleType('fabconfig')
+fabconfig.env = env
+sys.modules['fabconfig'] = fabconfig
+
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+
+SERVICES = [
+    'boto.ec2',
+    'boto.ec2.elb',
+    'boto.ec2.autoscale',
+    'boto.ec2.cloudwatch',
+    'boto.route53',
+    'boto.s3']
+
+
+SCENARIOS = [
+    ('fab --list', []),
+    ('ec2 only', ['ec2']),
+    ('every service', [service.split('.')[-1] for service in SERVICES]),
+]
+
+
+def run_scenario(attribute_names):
+    """
+    Time a fresh process loading the fabfile, building ``env.connections``
+    and using the given services, as ``fab`` followed by a task would. Also
+    prints how many boto modules that imported.
+    """
+    env.region = 'eu-west-1'
+    env.profile_name = None
+
+    start = time.time()
+    imp.load_source('fabfile', FABFILE)
+    from tangentdeployer.aws import utils
+    connections = utils.BotoConnection(profile_name=None, services=SERVICES)
+    for attribute_name in attribute_names:
+        getattr(connections, attribute_name)
+    print('%f %d' % ((time.time() - start) * 1000, len([
+        name for name in sys.modules
+        if name.startswith('boto') and sys.modules[name]])))
+
+
+def main(repeat=5):
+    for name, attribute_names in SCENARIOS:
+        timings = [
+            subprocess.check_output(
+                [sys.executable, __file__] + attribute_names + ['--run']
+            ).split()
+            for _ in range(repeat)
+        ]
+        print('%-16s %8.1f ms (best of %d), %s boto modules' % (
+            name, min(float(timing[0]) for timing in timings), repeat,
+            timings[0][1]))
+
+
+if __name__ == '__main__':
+    if sys.argv[-1] == '--run':
+        run_scenario(sys.argv[1:-1])
+    else:
+        main()
@@ -0,0 +1,35 @@
+#!/bin/sh
+
+# Everything an app instance needs that doesn't change from one deploy to
+# the next. `fab <environment> bake` builds an AMI with this already run;
+# instances booting from any other AMI run it ahead of app-user-data.sh.
+
+set -e
+
+echo "Europe/London" > /etc/timezone
+
+dpkg-reconfigure -f noninteractive tzdata
+
+echo "Installing AWS CLI"
+apt-get update
+apt-get install -y awscli
+
+apt-get install -y nagios-nrpe-server
+
+echo "Update docker"
+wget -qO- https://get.docker.com/ | sh
+service docker restart
+
+{% if pull_images %}
+# Only when baking, instances booting from another AMI pull the images
+# concurrently in app-user-data.sh instead
+echo "Pre-pulling docker images"
+aws s3 cp --region={{ region }} s3://{{ s3_path }}/{{ env }}/bootstrap/dockercfg /root/.dockercfg
+for IMAGE in {{ app_docker_image }} {{ nginx_docker_image }}{% if use_logstash %} {{ logstash_docker_image }}{% endif %}{% if use_rabbitmq %} {{ rabbitmq_docker_image }}{% endif %}{% if use_memcached %} {{ memcached_docker_image }}{% endif %}; do
+    su - root -c "docker pull {{ docker_host }}/$IMAGE"
+done
+
+# The registry credentials mustn't end up in the AMI. app-user-data.sh puts
+# them back on every boot.
+rm -f /root/.dockercfg
+{% endif %}
@@ -0,0 +1,40 @@
+#!/bin/sh
+
+# Brings a running app instance up to date for a deploy: the current
+# bootstrap bundle's config, the latest app and nginx images, and fresh app
+# and nginx containers. The services the app links to keep running.
+
+set -e
+
+export DOCKER_HOST="{{ docker_host }}"
+export DOCKER_IMAGE="{{ app_docker_image }}"
+export NGINX_DOCKER_IMAGE="{{ nginx_docker_image }}"
+export REGION="{{ region }}"
+export ENV="{{ env }}"
+export BOOTSTRAP_DIR=/tmp/bootstrap
+
+rm -rf $BOOTSTRAP_DIR
+mkdir -p $BOOTSTRAP_DIR
+aws s3 cp --region=$REGION s3://{{ s3_bootstrap_bucket }}/{{ bootstrap_bundle }} - | tar xz -C $BOOTSTRAP_DIR
+
+cp $BOOTSTRAP_DIR/dockercfg /home/ubuntu/.dockercfg
+cp $BOOTSTRAP_DIR/dockercfg /root/.dockercfg
+cp $BOOTSTRAP_DIR/nagios/nrpe.cfg /etc/nagios/nrpe.cfg
+cp $BOOTSTRAP_DIR/nagios/nrpe_local.cfg /etc/nagios/nrpe_local.cfg
+cp $BOOTSTRAP_DIR/logrotate.d/* /etc/logrotate.d/
+/etc/init.d/nagios-nrpe-server restart
+
+echo "Pulling docker images"
+docker pull $DOCKER_HOST/$DOCKER_IMAGE &
+APP_PULL=$!
+docker pull $DOCKER_HOST/$NGINX_DOCKER_IMAGE &
+NGINX_PULL=$!
+wait $APP_PULL
+wait $NGINX_PULL
+
+docker run --rm -v /var/log:/var/log -e DJANGO_SETTINGS_MODULE=conf.$ENV $DOCKER_HOST/$DOCKER_IMAGE /www/manage.py collectstatic --noinput
+
+echo "Replacing the app and nginx containers"
+docker rm -f app nginx || true
+docker run -d --name app -v /var/log:/var/log{% if use_rabbitmq %} --link rabbitmq:rabbitmq{% endif %}{% if use_memcached %} --link memcached:memcached{% endif %} -p 8000:8000 -e DJANGO_SETTINGS_MODULE="conf.$ENV" -e ENV=$ENV $DOCKER_HOST/$DOCKER_IMAGE
+docker run -d --name nginx -p 80:80 -v /var/log:/var/log -v /root/app.nginx.conf:/etc/nginx/sites-enabled/default --net=host $DOCKER_HOST/$NGINX_DOCKER_IMAGE
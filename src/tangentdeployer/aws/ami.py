@@ -0,0 +1,121 @@
+import time
+import hashlib
+import utils
+import waiter
+
+from fabconfig import env
+
+"""
+Baked AMIs are tagged with the hash of the base AMI and rendered bake
+script they were built from, so a deploy can tell whether one is current.
+"""
+BOOTSTRAP_HASH_TAG = 'bootstrap-hash'
+
+
+def base_image_id():
+    """
+    The AMI baked images are built on. That's ``env.ami_image_id`` until a
+    baked image replaces it, unless ``env.base_ami_image_id`` is set.
+    """
+    return env.get('base_ami_image_id') or env.ami_image_id
+
+
+def bootstrap_hash():
+    digest = hashlib.sha1(base_image_id().encode('utf-8'))
+    digest.update(utils.get_app_bake_script(env=env).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_baked_image(digest):
+    images = env.connections.ec2.get_all_images(
+        owners=['self'],
+        filters={
+            'tag:project': env.project,
+            'tag:%s' % BOOTSTRAP_HASH_TAG: digest,
+            'state': 'available',
+        })
+    return images[0] if images else None
+
+
+def use_image(image):
+    env.base_ami_image_id = base_image_id()
+    env.ami_image_id = image.id
+    env.baked_image = True
+
+
+def use_baked_image():
+    """
+    Launch app instances from the baked AMI if there's one for the current
+    bootstrap, so their user data only has to do the per deploy part.
+    Otherwise they boot from ``env.ami_image_id`` and run the whole thing.
+    """
+    utils.status('Looking for a baked AMI')
+    image = get_baked_image(digest=bootstrap_hash())
+    if image is None:
+        utils.success('No AMI is baked from the current bootstrap, booting '
+                      'from %s. Run the bake task to speed boots up.' %
+                      env.ami_image_id)
+        return None
+    use_image(image=image)
+    utils.success('Using baked AMI %s' % image.id)
+    return image
+
+
+def bake():
+    """
+    Build an AMI from the base AMI with the bake script already run and
+    tag it with the bootstrap hash. The script runs as the user data of a
+    temporary instance that powers itself off when it's done, and we image
+    it once it has stopped.
+    """
+    digest = bootstrap_hash()
+    image = get_baked_image(digest=digest)
+    if image is not None:
+        use_image(image=image)
+        utils.success('AMI %s is already baked from the current bootstrap' %
+                      image.id)
+        return image
+
+    utils.status('Launching an instance to bake an AMI from %s' %
+                 base_image_id())
+    reservation = env.connections.ec2.run_instances(
+        image_id=base_image_id(),
+        min_count=1,
+        max_count=1,
+        key_name='%s-%s' % (env.project, env.environment),
+        security_groups=['%s' % env.environment],
+        user_data=utils.get_app_bake_script(env=env) + '\nshutdown -h now\n',
+        instance_type=env.instance_type,
+        instance_initiated_shutdown_behavior='stop',
+        instance_profile_name='%s-ec2-%s' % (env.project, env.environment)
+    )
+    instance = reservation.instances[0]
+    try:
+        utils.status('Waiting on the bake script to finish')
+        waiter.wait(
+            poll=lambda: [instance.update()],
+            ready=lambda instance_status: instance_status == 'stopped',
+            description='Baking instance',
+            timeout=env.get('bake_timeout', 1800))
+
+        utils.status('Creating AMI')
+        image_id = env.connections.ec2.create_image(
+            instance_id=instance.id,
+            name='%s-app-%s-%d' % (env.project, digest[:12], time.time()),
+            description='%s app, bootstrap %s' % (env.project, digest))
+        env.connections.ec2.create_tags([image_id], {
+            'Name': '%s-app' % env.project,
+            'project': env.project,
+            BOOTSTRAP_HASH_TAG: digest,
+        })
+        image = waiter.wait(
+            poll=lambda: env.connections.ec2.get_all_images(
+                image_ids=[image_id]),
+            ready=lambda image: image.state == 'available',
+            description='AMI %s' % image_id)[0]
+    finally:
+        env.connections.ec2.terminate_instances(instance_ids=[instance.id])
+
+    use_image(image=image)
+    utils.success('Finished baking AMI %s' % image.id)
+    return image
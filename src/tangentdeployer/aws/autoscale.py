@@ -1,13 +1,61 @@
+import re
+import json
 import time
 import utils
+import hashlib
 import datetime
-import boto.ec2.autoscale
+import functools
+import threading
+import contextlib
+import collections
 
 from . import ec2
+from . import pool
+from . import waiter
+from .inventory import GroupInventory
 from fabconfig import env
 
-
-def create_autoscaling_group(load_balancer):
+groups = GroupInventory()
+
+"""
+The most tags we send in a single CreateOrUpdateTags request.
+"""
+TAGS_PER_REQUEST = 50
+
+"""
+DescribeLaunchConfigurations returns at most 50 configurations per page.
+"""
+LAUNCH_CONFIG_PAGE_SIZE = 50
+
+"""
+Unreferenced launch configurations younger than this many seconds are left
+alone by the garbage collection, in case a deploy running alongside us has
+just created one and not yet created its group.
+"""
+LAUNCH_CONFIG_GC_MIN_AGE = 3600
+
+"""
+Launch configurations are named after the project and a 20 character digest
+of their settings. The garbage collection only touches names of exactly that
+form, not another project's whose name starts with ours.
+"""
+LAUNCH_CONFIG_NAME = 'lc-%s-%s'
+LAUNCH_CONFIG_DIGEST_LENGTH = 20
+
+"""
+Each thread has its own tag batch, so a tag() from another deploy step
+isn't queued into, or lost with, a batch it has nothing to do with.
+"""
+tag_batches = threading.local()
+
+
+def create_autoscaling_group(load_balancer, asg_type='QA', wait=True):
+    """
+    Create a group of ``asg_type`` behind the load balancer, with
+    AddToLoadBalancer suspended. Unless ``wait`` is off we wait for it to
+    have instances before returning it.
+    """
+    import boto.ec2.autoscale
     launch_configuration = create_launch_configuration()
 
     utils.status("Create auto scaling group")
@@ -38,23 +86,22 @@ def create_autoscaling_group(load_balancer):
     env.connections.autoscale.suspend_processes(
         autoscaling_group.name, scaling_processes=['AddToLoadBalancer'])
 
-    tag(autoscaling_group=autoscaling_group, key='type', value='QA')
-    tag(autoscaling_group=autoscaling_group, key='env', value=env.environment)
-    tag(autoscaling_group=autoscaling_group,
-        key='Name',
-        value='%(project)s-%(environment)s' % env,
-        propagate_at_launch=True)
-
-    scale_up_policy = create_scaling_up_policy(
-        autoscaling_group=autoscaling_group)
-    scale_down_policy = create_scaling_down_policy(
-        autoscaling_group=autoscaling_group)
-    create_scaling_up_alarm(
-        scale_up_policy=scale_up_policy,
-        autoscaling_group=autoscaling_group)
-    create_scaling_down_alarm(
-        scale_down_policy=scale_down_policy,
-        autoscaling_group=autoscaling_group)
+    with tag_batch():
+        tag(autoscaling_group=autoscaling_group, key='type', value=asg_type)
+        tag(autoscaling_group=autoscaling_group,
+            key='env',
+            value=env.environment)
+        tag(autoscaling_group=autoscaling_group,
+            key='Name',
+            value='%(project)s-%(environment)s' % env,
+            propagate_at_launch=True)
+
+    # Alarm names aren't per group, so standby groups only get their scaling
+    # rules once they're promoted
+    if asg_type != 'Standby':
+        create_scaling_rules(autoscaling_group=autoscaling_group)
+    if not wait:
+        return autoscaling_group
 
     """
     Before returning the Autoscaling group, we poll AWS until we have some
@@ -62,111 +109,204 @@ def create_autoscaling_group(load_balancer):
     instances attached to the Autoscaling group.
     """
     utils.status('Waiting on some instances...')
-    while not autoscaling_group.instances:
-        time.sleep(1)
-        autoscaling_group = get(asg_type='QA')
+    return wait_for_instances(autoscaling_group=autoscaling_group)
+
+
+def wait_for_instances(autoscaling_group):
+    if autoscaling_group.instances:
+        return autoscaling_group
+    return waiter.wait(
+        poll=lambda: [refresh(autoscaling_group)],
+        ready=lambda group: group.instances,
+        description='Instances in %s' % autoscaling_group.name)[0]
+
+
+def replace_launch_configuration(autoscaling_group):
+    """
+    Point an existing group at a new launch configuration for this deploy,
+    so anything it launches from now on gets the current AMI and user data,
+    and delete the one it had.
+    """
+    utils.status('Replacing the launch config of %s' % autoscaling_group.name)
+    old_launch_config_name = autoscaling_group.launch_config_name
+    launch_configuration = create_launch_configuration()
+    if launch_configuration.name == old_launch_config_name:
+        return autoscaling_group
+    autoscaling_group.launch_config_name = launch_configuration.name
+    autoscaling_group.update()
+    delete_launch_configuration(name=old_launch_config_name)
     return autoscaling_group
 
 
 def create_launch_configuration():
+    """
+    Launch configurations are named after a hash of everything in them, so
+    a deploy that changes nothing reuses the one it made last time, e.g.
+    after an abort.
+    """
+    import boto.ec2.autoscale
+    from boto.exception import BotoServerError
     utils.status("Create the launch config")
+    settings = {
+        'image_id': env.ami_image_id,
+        'key_name': '%s-%s' % (env.project, env.environment),
+        'security_groups': ['%s' % env.environment],
+        'user_data': utils.get_app_user_data(env=env),
+        'instance_type': env.instance_type,
+        'instance_profile_name': '%s-ec2-%s' % (
+            env.project, env.environment),
+    }
+    digest = hashlib.sha1(json.dumps(settings, sort_keys=True).encode('utf-8'))
     launch_configuration = boto.ec2.autoscale.LaunchConfiguration(
-        name='lc-%s-%s' % (env.project, time.time()),
-        image_id=env.ami_image_id,
-        key_name='%s-%s' % (env.project, env.environment),
-        security_groups=['%s' % env.environment],
-        user_data=utils.get_app_user_data(env=env),
-        instance_type=env.instance_type,
-        instance_profile_name='%s-ec2-%s' % (env.project, env.environment)
-    )
-    env.connections.autoscale.create_launch_configuration(launch_configuration)
+        name=LAUNCH_CONFIG_NAME % (
+            env.project, digest.hexdigest()[:LAUNCH_CONFIG_DIGEST_LENGTH]),
+        **settings)
+    try:
+        env.connections.autoscale.create_launch_configuration(
+            launch_configuration)
+    except BotoServerError as e:
+        if e.error_code != 'AlreadyExists':
+            raise
+        utils.status('Reusing launch config %s' % launch_configuration.name)
     return launch_configuration
 
 
-def create_scaling_up_policy(autoscaling_group):
-    utils.status('Creating scaling up policy...')
-    name = '%s-%s-scale-up' % (env.project, env.environment)
-    scale_up_policy = boto.ec2.autoscale.ScalingPolicy(
-        name=name,
-        adjustment_type='ChangeInCapacity',
-        as_name=autoscaling_group.name,
-        scaling_adjustment=env.asg_adjustment_up,
-        cooldown=env.asg_default_cooldown
-    )
-    env.connections.autoscale.create_scaling_policy(scale_up_policy)
-
-    # We need to hit the API for the created policy to get it's new ARN
-    scale_up_policy = env.connections.autoscale.get_all_policies(
-        as_group=autoscaling_group.name,
-        policy_names=[name])[0]
-    utils.success('Finished creating scaling up policy.')
-    return scale_up_policy
-
-
-def create_scaling_down_policy(autoscaling_group):
-    utils.status('Creating scaling down policy...')
-    name = '%s-%s-scale-down' % (env.project, env.environment)
-    scale_down_policy = boto.ec2.autoscale.ScalingPolicy(
-        name=name,
-        adjustment_type='ChangeInCapacity',
-        as_name=autoscaling_group.name,
-        scaling_adjustment=env.asg_adjustment_down,
-        cooldown=env.asg_default_cooldown
-    )
-    env.connections.autoscale.create_scaling_policy(scale_down_policy)
-
-    # We need to hit the API for the created policy to get it's new ARN
-    scale_down_policy = env.connections.autoscale.get_all_policies(
-        as_group=autoscaling_group.name,
-        policy_names=[name])[0]
-    utils.success('Finished creating scaling down policy.')
-    return scale_down_policy
+def scaling_rules():
+    """
+    The scaling policies every group gets, each paired with the CloudWatch
+    alarm that triggers it. Set ``env.scaling_rules`` to a list of dicts
+    like these to use your own.
+    """
+    return env.get('scaling_rules') or [
+        {
+            'name': 'scale-up',
+            'adjustment': env.asg_adjustment_up,
+            'comparison': env.cw_comparison_gt,
+            'threshold': env.cw_threshold_up,
+        },
+        {
+            'name': 'scale-down',
+            'adjustment': env.asg_adjustment_down,
+            'comparison': env.cw_comparison_lt,
+            'threshold': env.cw_threshold_down,
+        },
+    ]
 
 
-def create_scaling_up_alarm(scale_up_policy, autoscaling_group):
-    utils.status('Creating scaling up alarm...')
-    name = '%s-%s-scale-up-alarm' % (env.project, env.environment)
-    scale_up_alarm = boto.ec2.cloudwatch.MetricAlarm(
-        name=name,
+def create_scaling_rules(autoscaling_group, rules=None):
+    """
+    Create every scaling policy and its alarm. The rules don't depend on
+    each other so they're created concurrently, and each alarm is created
+    as soon as its policy's ARN comes back.
+    """
+    rules = rules or scaling_rules()
+    utils.status('Creating %d scaling policies and alarms' % len(rules))
+    pool.concurrent_map(
+        functools.partial(create_scaling_rule,
+                          autoscaling_group=autoscaling_group),
+        rules)
+    utils.success('Finished creating scaling policies and alarms')
+
+
+def create_scaling_rule(rule, autoscaling_group):
+    import boto.ec2.cloudwatch
+    policy_arn = put_scaling_policy(
+        name='%s-%s-%s' % (env.project, env.environment, rule['name']),
+        autoscaling_group=autoscaling_group,
+        scaling_adjustment=rule['adjustment'])
+    alarm = boto.ec2.cloudwatch.MetricAlarm(
+        name='%s-%s-%s-alarm' % (env.project, env.environment, rule['name']),
         namespace=env.cw_namespace,
         metric=env.cw_metric,
         statistic=env.cw_statistic,
-        comparison=env.cw_comparison_gt,
-        threshold=env.cw_threshold_up,
+        comparison=rule['comparison'],
+        threshold=rule['threshold'],
         period=env.cw_period,
         evaluation_periods=env.cw_evaluation_periods,
-        alarm_actions=[scale_up_policy.policy_arn],
+        alarm_actions=[policy_arn],
         dimensions={'AutoScalingGroupName': autoscaling_group.name})
-    env.connections.cloudwatch.create_alarm(scale_up_alarm)
-    utils.success('Finished creating scaling up alarm.')
+    env.connections.cloudwatch.create_alarm(alarm)
 
 
-def create_scaling_down_alarm(scale_down_policy, autoscaling_group):
-    utils.status('Creating scaling down alarm...')
-    name = '%s-%s-scale-down-alarm' % (env.project, env.environment)
-    scale_down_alarm = boto.ec2.cloudwatch.MetricAlarm(
-        name=name,
-        namespace=env.cw_namespace,
-        metric=env.cw_metric,
-        statistic=env.cw_statistic,
-        comparison=env.cw_comparison_lt,
-        threshold=env.cw_threshold_down,
-        period=env.cw_period,
-        evaluation_periods=env.cw_evaluation_periods,
-        alarm_actions=[scale_down_policy.policy_arn],
-        dimensions={'AutoScalingGroupName': autoscaling_group.name})
-    env.connections.cloudwatch.create_alarm(scale_down_alarm)
-    utils.success('Finished creating scaling down alarm.')
+def put_scaling_policy(name, autoscaling_group, scaling_adjustment):
+    """
+    Create or update a ChangeInCapacity scaling policy and return its ARN.
+    PutScalingPolicy responds with the ARN, but boto's
+    create_scaling_policy throws the response away, so we make the request
+    ourselves rather than fetching the policy back with DescribePolicies.
+    """
+    params = {
+        'AdjustmentType': 'ChangeInCapacity',
+        'AutoScalingGroupName': autoscaling_group.name,
+        'PolicyName': name,
+        'ScalingAdjustment': scaling_adjustment,
+        'Cooldown': env.asg_default_cooldown,
+    }
+    return env.connections.autoscale.get_object(
+        'PutScalingPolicy', params, PutScalingPolicyResult).policy_arn
+
+
+class PutScalingPolicyResult(object):
+
+    def __init__(self, connection=None):
+        self.policy_arn = None
+
+    def startElement(self, name, attrs, connection):
+        return None
+
+    def endElement(self, name, value, connection):
+        if name == 'PolicyARN':
+            self.policy_arn = value
 
 
 def tag(autoscaling_group, key, value, propagate_at_launch=False):
-    utils.status('Tagging ASG with %s:%s' % (key, value))
+    import boto.ec2.autoscale.tag
     tag = boto.ec2.autoscale.tag.Tag(
         key=key,
         value=value,
         propagate_at_launch=propagate_at_launch,
         resource_id=autoscaling_group.name)
-    env.connections.autoscale.create_or_update_tags([tag])
+    pending_tags = getattr(tag_batches, 'pending_tags', None)
+    if pending_tags is not None:
+        utils.status('Queueing ASG tag %s:%s' % (key, value))
+        pending_tags[(tag.resource_id, tag.key)] = tag
+        return
+    utils.status('Tagging ASG with %s:%s' % (key, value))
+    write_tags(tags=[tag])
+
+
+@contextlib.contextmanager
+def tag_batch():
+    """
+    Queue up every tag() made inside the block and write them in as few
+    CreateOrUpdateTags requests as possible when it exits, with later writes
+    to the same group and key replacing earlier ones.
+
+    The inventory isn't updated until the flush, so lookups inside the block
+    still see the groups as they were before it. That lets us swap types
+    (QA -> Active, Active -> Inactive) without one tag change being picked
+    up by the next lookup. If the block raises, nothing is written.
+    """
+    if getattr(tag_batches, 'pending_tags', None) is not None:
+        yield
+        return
+    tag_batches.pending_tags = collections.OrderedDict()
+    try:
+        yield
+        tags = list(tag_batches.pending_tags.values())
+    finally:
+        tag_batches.pending_tags = None
+    if tags:
+        utils.status('Writing %d ASG tags' % len(tags))
+        write_tags(tags=tags)
+
+
+def write_tags(tags):
+    for index in range(0, len(tags), TAGS_PER_REQUEST):
+        env.connections.autoscale.create_or_update_tags(
+            tags[index:index + TAGS_PER_REQUEST])
+    for tag in tags:
+        groups.update_tag(tag)
 
 
 def get(asg_type):
@@ -177,38 +317,155 @@ def get(asg_type):
 
 
 def get_all(asg_type):
-    return [
-        env_group
-        for env_group in get_env_groups()
-        for tag in env_group.tags
-        if tag.key == 'type' and tag.value == asg_type
-    ]
+    return groups.find(environment=env.environment, asg_type=asg_type)
 
 
 def get_env_groups():
-    return [
-        env_group
-        for env_group in env.connections.autoscale.get_all_groups()
-        for tag in env_group.tags
-        if tag.key == 'env' and tag.value == env.environment
-    ]
+    return groups.in_environment(environment=env.environment)
+
+
+def refresh(autoscaling_group):
+    """
+    Re-fetch a single group by name, e.g. to pick up instances that have
+    launched since we last looked at it. Newly created groups can take a
+    moment to show up in the API, until then we keep the one we have.
+    """
+    return groups.refresh(autoscaling_group.name) or autoscaling_group
+
+
+def delete(autoscaling_group):
+    autoscaling_group.shutdown_instances()
+    autoscaling_group.delete(force_delete=True)
+    groups.forget(autoscaling_group.name)
 
 
 def scale_down(autoscaling_group):
+    """
+    Scale a group we've just taken out of service down to a warm floor of
+    ``env.inactive_warm_floor`` instances (1 by default), which a rollback
+    can scale back up from. If ``env.inactive_retention`` is set the floor
+    is only kept for that many seconds, after which the group is emptied.
+    """
+    now = datetime.datetime.now()
+    warm_floor = env.get('inactive_warm_floor', 1)
     env.connections.autoscale.create_scheduled_group_action(
         as_group=autoscaling_group.name,
         name='decrease-minimum-capacity',
-        desired_capacity=1,
-        min_size=1,
-        start_time=datetime.datetime.now() + datetime.timedelta(seconds=30))
+        desired_capacity=warm_floor,
+        min_size=warm_floor,
+        start_time=now + datetime.timedelta(seconds=30))
+    if env.get('inactive_retention'):
+        env.connections.autoscale.create_scheduled_group_action(
+            as_group=autoscaling_group.name,
+            name='end-retention',
+            desired_capacity=0,
+            min_size=0,
+            start_time=now + datetime.timedelta(
+                seconds=env.inactive_retention))
+
+
+def scale_up(autoscaling_group):
+    """
+    Bring a scaled down group back to live capacity, cancelling any scale
+    downs still scheduled for it, and wait for the instances to be in
+    service.
+
+    Instances launched to make up the numbers boot from the group's launch
+    configuration, which pulls whatever ``env.app_docker_image`` names. Unless
+    that's pinned to a release tag, that's the newest image, not the one
+    the group was running.
+    """
+    from boto.exception import BotoServerError
+    for name in ('decrease-minimum-capacity', 'end-retention'):
+        try:
+            env.connections.autoscale.delete_scheduled_action(
+                scheduled_action_name=name,
+                autoscale_group=autoscaling_group.name)
+        except BotoServerError as e:
+            # Already run, or never scheduled
+            if e.error_code != 'ValidationError':
+                raise
+    autoscaling_group.min_size = env.asg_min_size
+    autoscaling_group.max_size = env.asg_max_size
+    autoscaling_group.desired_capacity = env.asg_desired_capacity
+    autoscaling_group.update()
+    return waiter.wait(
+        poll=lambda: [refresh(autoscaling_group)],
+        ready=lambda group: len(
+            in_service(autoscaling_group=group)) >= env.asg_desired_capacity,
+        description='Instances in service in %s' % autoscaling_group.name)[0]
+
+
+def in_service(autoscaling_group):
+    return [
+        instance
+        for instance in autoscaling_group.instances
+        if instance.lifecycle_state == 'InService'
+    ]
 
 
 def delete_launch_config(autoscaling_group):
     utils.status('Deleting launch config')
-    launch_config = env.connections.autoscale.get_all_launch_configurations(
-        names=[autoscaling_group.launch_config_name])[0]
-    launch_config.delete()
-    utils.success('Launch config deleted')
+    if delete_launch_configuration(name=autoscaling_group.launch_config_name):
+        utils.success('Launch config deleted')
+
+
+def delete_launch_configuration(name):
+    """
+    Delete a launch configuration unless another group still uses it, which
+    content addressed configurations can be. Returns whether it went.
+    """
+    from boto.exception import BotoServerError
+    if name in referenced_launch_configurations():
+        utils.status('Keeping launch config %s, it is still in use' % name)
+        return False
+    try:
+        env.connections.autoscale.delete_launch_configuration(name)
+    except BotoServerError as e:
+        # A group we don't know about yet, or one still being deleted
+        if e.error_code != 'ResourceInUse':
+            raise
+        return False
+    return True
+
+
+def referenced_launch_configurations():
+    return set(group.launch_config_name for group in groups.all())
+
+
+def collect_launch_configurations():
+    """
+    Delete the project's launch configurations that no group references,
+    like the ones left behind by failed deploys.
+    """
+    utils.status('Collecting unused launch configs')
+    referenced = referenced_launch_configurations()
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=env.get('launch_config_gc_min_age', LAUNCH_CONFIG_GC_MIN_AGE))
+    unused = [
+        launch_configuration.name
+        for launch_configuration in project_launch_configurations()
+        if launch_configuration.name not in referenced
+        and launch_configuration.created_time < cutoff
+    ]
+    deleted = pool.concurrent_map(
+        lambda name: delete_launch_configuration(name=name), unused)
+    utils.success('Deleted %d unused launch configs' % deleted.count(True))
+
+
+def project_launch_configurations():
+    name_pattern = re.compile('^%s$' % LAUNCH_CONFIG_NAME % (
+        re.escape(env.project), '[0-9a-f]{%d}' % LAUNCH_CONFIG_DIGEST_LENGTH))
+    next_token = None
+    while True:
+        page = env.connections.autoscale.get_all_launch_configurations(
+            max_records=LAUNCH_CONFIG_PAGE_SIZE, next_token=next_token)
+        for launch_configuration in page:
+            if name_pattern.match(launch_configuration.name):
+                yield launch_configuration
+        next_token = page.next_token
+        if not next_token:
+            return
 
 
 def tag_inactive_as_old():
@@ -241,33 +498,30 @@ def delete_old():
     old_autoscale_group = get(asg_type='Old')
     if not old_autoscale_group:
         return
-    old_launch_config_name = old_autoscale_group.launch_config_name
-    old_autoscale_group.shutdown_instances()
-    old_autoscale_group.delete(force_delete=True)
+    delete(old_autoscale_group)
     utils.status("Deleting old launch configuration")
-    env.connections.autoscale.delete_launch_configuration(
-        old_launch_config_name)
+    delete_launch_configuration(name=old_autoscale_group.launch_config_name)
 
 
 def assign_elastic_ip_addresses(autoscaling_group):
     utils.status("Waiting on the new load balancer to get instances")
-    while not autoscaling_group.instances:
-        time.sleep(1)
-        autoscaling_group = get(asg_type='QA')
+    autoscaling_group = wait_for_instances(autoscaling_group=autoscaling_group)
     addresses = env.connections.ec2.get_all_addresses()
 
     free_addresses = filter(lambda x: x.instance_id is None, addresses)
     utils.success("Got the following addresses: %s" % addresses)
 
+    utils.status("Waiting on instances to spin up...")
+    waiter.wait(
+        poll=ec2.group_instances_poller(autoscaling_group=autoscaling_group),
+        ready=lambda instance: instance and instance.state == 'running',
+        description='Running instances')
+
     for index, instance in enumerate(autoscaling_group.instances):
-        utils.status("Waiting on instances to spin up...")
-        instance_obj = ec2.get(instance_id=instance.instance_id)
-        while instance_obj.state != 'running':
-            time.sleep(1)
-            instance_obj = ec2.get(instance_id=instance.instance_id)
-            print('Instance status: %s' % instance_obj.state)
         address = free_addresses.pop(index)
         env.connections.ec2.associate_address(
             instance.instance_id, address.public_ip)
+        # The public DNS name changes with the new address
+        ec2.invalidate(instance_ids=[instance.instance_id])
         utils.status(
             "Assigned %s to %s" % (address.public_ip, instance.instance_id))
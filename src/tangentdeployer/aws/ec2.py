@@ -1,25 +1,105 @@
+import io
+import os
 import time
-import boto
-import boto.s3
-import boto.s3.key
-import boto.ec2.autoscale
-import boto.ec2.cloudwatch
-import boto.ec2.elb
-import boto.route53
+import tarfile
+import itertools
 
 from fabconfig import env
-from fabric.operations import run
-from fabric.contrib.files import upload_template
+from fabric.operations import put, run
 
 import utils
+import waiter
+import route53
+import templating
+
+"""
+How long (in seconds) a batch of instance descriptions is shared between the
+steps of a deploy before we go back to the API for fresh ones.
+"""
+SNAPSHOT_TTL = 5
+
+"""
+DescribeInstances accepts at most 1000 results per page and we keep the
+instance-id filter to 200 values per call.
+"""
+PAGE_SIZE = 1000
+FILTER_VALUES_LIMIT = 200
+
+snapshot = {}
 
 
 def get(instance_id):
-    reservations = env.connections.ec2.get_all_instances(
-        instance_ids=[instance_id])
-    if not reservations:
-        return
-    return reservations[0].instances[0]
+    return get_many(instance_ids=[instance_id], max_age=0).get(instance_id)
+
+
+def get_many(instance_ids, max_age=SNAPSHOT_TTL):
+    """
+    Describe a batch of instances, returning a dict of instance id to
+    instance.
+
+    Instances described within the last ``max_age`` seconds are served from
+    the shared snapshot; everything else is fetched with a single paginated
+    DescribeInstances call per 200 ids.
+    """
+    now = time.time()
+    stale_ids = [
+        instance_id
+        for instance_id in instance_ids
+        if instance_id not in snapshot
+        or now - snapshot[instance_id][1] >= max_age
+    ]
+    for index in range(0, len(stale_ids), FILTER_VALUES_LIMIT):
+        chunk = stale_ids[index:index + FILTER_VALUES_LIMIT]
+        for instance in describe_instances(filters={'instance-id': chunk}):
+            snapshot[instance.id] = (instance, now)
+    return dict(
+        (instance_id, snapshot[instance_id][0])
+        for instance_id in instance_ids
+        if instance_id in snapshot
+    )
+
+
+def describe_instances(filters):
+    next_token = None
+    while True:
+        reservations = env.connections.ec2.get_all_reservations(
+            filters=filters, max_results=PAGE_SIZE, next_token=next_token)
+        for reservation in reservations:
+            for instance in reservation.instances:
+                yield instance
+        next_token = reservations.next_token
+        if not next_token:
+            return
+
+
+def get_group_instances(autoscaling_group, max_age=SNAPSHOT_TTL):
+    """
+    Describe every instance in an autoscaling group, in the group's order.
+    Instances EC2 doesn't know about yet come back as None.
+    """
+    instances = get_many(
+        instance_ids=[
+            instance.instance_id for instance in autoscaling_group.instances],
+        max_age=max_age)
+    return [
+        instances.get(instance.instance_id)
+        for instance in autoscaling_group.instances
+    ]
+
+
+def group_instances_poller(autoscaling_group):
+    """
+    A waiter poll for a group's instances. The first poll can be answered
+    from the shared snapshot, every poll after that goes to the API.
+    """
+    max_ages = itertools.chain([SNAPSHOT_TTL], itertools.repeat(0))
+    return lambda: get_group_instances(
+        autoscaling_group=autoscaling_group, max_age=next(max_ages))
+
+
+def invalidate(instance_ids):
+    for instance_id in instance_ids:
+        snapshot.pop(instance_id, None)
 
 
 def provision_logging_instance():
@@ -42,11 +122,10 @@ def provision_logging_instance():
     for instance in logger_reservation.instances:
 
         utils.status("Waiting on logging instance to spin up...")
-        instance_status = instance.update()
-        while instance_status != 'running':
-            time.sleep(5)
-            instance_status = instance.update()
-            print('Instance status: %s' % instance_status)
+        waiter.wait(
+            poll=lambda: [instance.update()],
+            ready=lambda instance_status: instance_status == 'running',
+            description='Logging instance')
 
         utils.status("Naming instance")
         instance.add_tag('Name', '%s-logger' % env.project)
@@ -55,26 +134,24 @@ def provision_logging_instance():
         volume = get_logging_volume(instance)
 
         utils.status('Waiting on volume to be available')
-        while volume.status != 'available':
-            time.sleep(5)
-            volume.update()
-            print('Volume status: %s' % volume.status)
+        waiter.wait(
+            poll=lambda: [volume.update()],
+            ready=lambda volume_status: volume_status == 'available',
+            description='Logging volume')
 
         utils.status('Attaching volume')
         volume.attach(instance.id, '/dev/sda2')
 
     utils.status('Linking logs URL')
-    route53_zone = env.connections.route53.get_zone(env.zone)
-    while not instance.dns_name:
-        time.sleep(1)
-        instance.update()
+    waiter.wait(
+        poll=lambda: [instance.update() and instance],
+        ready=lambda instance: instance.dns_name,
+        description='Logging instance DNS name')
 
+    change_batch = route53.ChangeBatch()
     for url in env.logging_urls:
-        route53_zone.update_cname(
-            name=url,
-            value=instance.dns_name,
-            ttl=60
-        )
+        change_batch.upsert_cname(name=url, value=instance.dns_name, ttl=60)
+    change_batch.commit()
     utils.success('Finished provisioning logging instance')
 
 
@@ -94,6 +171,7 @@ def is_logger_instance_running():
 
 
 def get_logging_volume(instance):
+    import boto.ec2
     volume_filters = {'tag:Name': 'logger-volume'}
     volume_status_filters = {'block-device-mapping.status': 'attached'}
     status_filters = dict(
@@ -116,40 +194,82 @@ def create_logging_volume(instance):
 
 def deploy_nagios_config(autoscaling_group):
     utils.status("Waiting on all instances to get an IP address")
-    for index, instance in enumerate(autoscaling_group.instances):
-        instance_obj = get(instance_id=instance.instance_id)
-        while not instance_obj.dns_name:
-            time.sleep(1)
-            instance_obj = get(instance_id=instance.instance_id)
-        utils.status('Pushing nagios config files')
-        context = {
-            'group_name': env.nagios_group_name,
-            'host_name': '{project}-{environment}-{instance_id}'.format(
-                         project=env.project,
-                         environment=env.environment,
-                         instance_id=instance.instance_id),
-            'alias': instance_obj.dns_name,
-            'address': instance_obj.dns_name
-        }
-        destination = '{nagios_dir}/{project}-{env}-{instance_id}.cfg'.format(
-            nagios_dir=env.nagios_master_config_dir,
-            project=env.project,
-            env=env.environment,
-            instance_id=instance.instance_id)
-        upload_template(
-            filename=env.nagios_master_config_file,
-            destination=destination,
-            context=context,
-            use_jinja=True)
-        restart_nagios()
+    instance_objs = wait_for_dns_names(autoscaling_group=autoscaling_group)
+
+    utils.status('Pushing nagios config files')
+    config_files = [
+        (nagios_config_file_for_instance(instance=instance),
+         render_nagios_config(instance=instance, instance_obj=instance_obj))
+        for instance, instance_obj in zip(autoscaling_group.instances,
+                                          instance_objs)
+    ]
+    upload_nagios_config(config_files=config_files)
+    reload_nagios()
+
+
+def render_nagios_config(instance, instance_obj):
+    context = {
+        'group_name': env.nagios_group_name,
+        'host_name': '{project}-{environment}-{instance_id}'.format(
+                     project=env.project,
+                     environment=env.environment,
+                     instance_id=instance.instance_id),
+        'alias': instance_obj.dns_name,
+        'address': instance_obj.dns_name
+    }
+    return templating.render(
+        template_path=env.nagios_master_config_file, context=context)
+
+
+def upload_nagios_config(config_files):
+    """
+    Ship every rendered config file to the nagios master as a single archive
+    so a fleet costs one transfer rather than one per instance.
+    """
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w:gz') as tar:
+        for config_file, contents in config_files:
+            contents = contents.encode('utf-8')
+            tar_info = tarfile.TarInfo(name=os.path.basename(config_file))
+            tar_info.size = len(contents)
+            tar_info.mtime = time.time()
+            tar.addfile(tar_info, io.BytesIO(contents))
+    archive.seek(0)
+
+    remote_archive = '/tmp/%(project)s-%(environment)s-nagios.tar.gz' % env
+    put(archive, remote_archive)
+    run('tar xzf {archive} -C {nagios_dir} && rm {archive}'.format(
+        archive=remote_archive,
+        nagios_dir=env.nagios_master_config_dir))
+
+
+def wait_for_dns_names(autoscaling_group):
+    return waiter.wait(
+        poll=group_instances_poller(autoscaling_group=autoscaling_group),
+        ready=lambda instance: instance and instance.dns_name,
+        description='Public DNS names')
+
+
+def replace_nagios_config(new_autoscaling_group, old_autoscaling_group):
+    """
+    Monitor one group's instances instead of another's. Both changes go to
+    the nagios master, so they're made one after the other.
+    """
+    deploy_nagios_config(autoscaling_group=new_autoscaling_group)
+    if old_autoscaling_group:
+        remove_nagios_config(autoscaling_group=old_autoscaling_group)
 
 
 def remove_nagios_config(autoscaling_group):
     utils.status('Removing nagios config...')
-    for index, instance in enumerate(autoscaling_group.instances):
-        config_file = nagios_config_file_for_instance(instance=instance)
-        run('sudo /bin/rm -rf %s' % config_file)
-        restart_nagios()
+    config_files = [
+        nagios_config_file_for_instance(instance=instance)
+        for instance in autoscaling_group.instances
+    ]
+    if not config_files:
+        return
+    run('sudo /bin/rm -rf %s' % ' '.join(config_files))
+    reload_nagios()
 
 
 def nagios_config_file_for_instance(instance):
@@ -160,10 +280,14 @@ def nagios_config_file_for_instance(instance):
         instance_id=instance.instance_id)
 
 
-def restart_nagios():
+def reload_nagios():
+    """
+    Reloading rather than restarting keeps nagios monitoring everything
+    else while it picks up the new config.
+    """
     result = run('sudo /etc/nagios/check_config')
     if result.return_code != 0:
         utils.failure('Nagios config check failed, removing nagios config')
         run('rm -rf %(nagios_master_config_dir)s/*%(environment)s*' % env)
     else:
-        run('sudo /etc/init.d/nagios3 restart')
+        run('sudo /etc/init.d/nagios3 reload')
@@ -1,9 +1,14 @@
-import json
 import utils
-import boto.ec2.elb
+import waiter
 
 from fabconfig import env
-from fabric.api import local
+
+"""
+DescribeTags takes at most 20 load balancer names per request.
+"""
+TAGS_PER_DESCRIBE = 20
+
+tag_cache = {}
 
 
 def get_or_create_load_balancer():
@@ -29,6 +34,7 @@ def create_load_balancer():
 
 
 def create_health_check():
+    import boto.ec2.elb
     utils.status('Creating health check for load balancer')
     health_check = boto.ec2.elb.HealthCheck(
         interval=10,
@@ -57,68 +63,118 @@ def deregister_instances(load_balancer, autoscaling_group):
         load_balancer_name=load_balancer.name, instances=instances)
 
 
+def wait_for_healthy_instances(load_balancer, autoscaling_group):
+    """
+    Wait for the load balancer's health check to pass on every instance in
+    the group, giving up after ``env.cutover_timeout`` seconds.
+    """
+    instances = [
+        instance.instance_id
+        for instance in autoscaling_group.instances
+    ]
+    return waiter.wait(
+        poll=lambda: env.connections.elb.describe_instance_health(
+            load_balancer_name=load_balancer.name, instances=instances),
+        ready=lambda instance_state: instance_state.state == 'InService',
+        description='Healthy instances in %s' % load_balancer.name,
+        timeout=env.get('cutover_timeout', 300))
+
+
 def get(load_balancer_name):
+    from boto.exception import BotoServerError
     utils.status('Getting %s load balancer' % env.environment)
     try:
         load_balancers = env.connections.elb.get_all_load_balancers(
             load_balancer_names=[env.load_balancer_name])
-    except boto.exception.BotoServerError:
+    except BotoServerError:
         return None
     return load_balancers[0]
 
 
 def has_tag(load_balancer_name, key, value):
-    """
-    We fall back to using the AWS CLI tool here because boto doesn't
-    support adding tags to load balancers yet.
+    tags = get_tags(load_balancer_names=[load_balancer_name])[
+        load_balancer_name]
+    return tags.get('env') == env.environment and tags.get(key) == value
+
+
+def tag(load_balancer, tags):
+    utils.status('Tagging load balancer')
+    add_tags(load_balancer_name=load_balancer.name, tags=tags)
+    utils.success('Finished tagging load balancer')
+
 
-    As soon as https://github.com/boto/boto/issues/2549 is merged we're good
-    to change this to use boto.
+def get_tags(load_balancer_names):
     """
-    response = json.loads(local(
-        'aws elb describe-tags '
-        '--load-balancer-names %s '
-        '--region=%s --profile=%s' % (load_balancer_name,
-                                      env.region,
-                                      env.profile_name),
-        capture=True))
-    in_env = False
-    if 'TagDescriptions' in response:
-        for tag_description in response['TagDescriptions']:
-            for tag in tag_description['Tags']:
-                if tag['Key'] == 'env' and tag['Value'] == env.environment:
-                    in_env = True
-            for tag in tag_description['Tags']:
-                if tag['Key'] == 'type' and tag['Value'] == value and in_env:
-                    return True
-    return False
+    The tags of each load balancer, as a dict of name to tags. Tags are
+    cached per load balancer once fetched, anything not cached yet is
+    fetched with one DescribeTags request per 20 load balancers.
+    """
+    missing = [name for name in load_balancer_names if name not in tag_cache]
+    for index in range(0, len(missing), TAGS_PER_DESCRIBE):
+        describe_tags(load_balancer_names=missing[
+            index:index + TAGS_PER_DESCRIBE])
+    return dict(
+        (name, tag_cache.get(name, {}))
+        for name in load_balancer_names
+    )
 
 
-def tag(load_balancer, tags):
+def describe_tags(load_balancer_names):
+    params = {}
+    env.connections.elb.build_list_params(
+        params, load_balancer_names, 'LoadBalancerNames.member.%d')
+    tag_descriptions = env.connections.elb.get_list(
+        'DescribeTags', params, [('member', TagDescription)])
+    for tag_description in tag_descriptions:
+        tag_cache[tag_description.load_balancer_name] = \
+            dict(tag_description.tags)
+
+
+def add_tags(load_balancer_name, tags):
+    params = {'LoadBalancerNames.member.1': load_balancer_name}
+    for index, (key, value) in enumerate(sorted(tags.items())):
+        params['Tags.member.%d.Key' % (index + 1)] = key
+        params['Tags.member.%d.Value' % (index + 1)] = value
+    env.connections.elb.get_status('AddTags', params, verb='POST')
+    if load_balancer_name in tag_cache:
+        tag_cache[load_balancer_name].update(tags)
+
+
+class TagDescription(object):
     """
-    We fall back to using the AWS CLI tool here because boto doesn't
-    support adding tags to load balancers yet.
+    A load balancer's tags from a DescribeTags response. boto doesn't know
+    about ELB tags yet, see https://github.com/boto/boto/issues/2549
+    """
+
+    def __init__(self, connection=None):
+        self.load_balancer_name = None
+        self.tags = TagSet()
 
-    As soon as https://github.com/boto/boto/issues/2549 is merged we're good
-    to change this to use boto
+    def startElement(self, name, attrs, connection):
+        if name == 'Tags':
+            return self.tags
+
+    def endElement(self, name, value, connection):
+        if name == 'LoadBalancerName':
+            self.load_balancer_name = value
+
+
+class TagSet(dict):
+    """
+    AWS doesn't promise an order for each tag's Key and Value, so a tag is
+    only stored once its member has ended.
     """
-    utils.status('Tagging load balancer')
-    tags = make_tags(tags=tags)
-    local('aws elb add-tags '
-          '--load-balancer-names {lb_name} '
-          '--tags {tags} '
-          '--region={region} '
-          '--profile={profile_name}'.format(lb_name=load_balancer.name,
-                                            tags=tags,
-                                            region=env.region,
-                                            profile_name=env.profile_name)
-          )
 
-    utils.success('Finished tagging load balancer')
+    def __init__(self, connection=None):
+        self.current = {}
 
+    def startElement(self, name, attrs, connection):
+        return None
 
-def make_tags(tags):
-    return ' '.join(
-        'Key={key},Value={value}'.format(key=key, value=value)
-        for key, value in tags.iteritems()
-    )
+    def endElement(self, name, value, connection):
+        if name in ('Key', 'Value'):
+            self.current[name] = value
+        elif name == 'member':
+            if 'Key' in self.current:
+                self[self.current['Key']] = self.current.get('Value', '')
+            self.current = {}
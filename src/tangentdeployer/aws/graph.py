@@ -0,0 +1,127 @@
+import pool
+import tracing
+import utils
+import threading
+import traceback
+import collections
+
+from multiprocessing.pool import ThreadPool
+
+
+class TaskGraphError(Exception):
+    pass
+
+
+class TaskGraph(object):
+    """
+    Runs deploy steps on a pool of worker threads, starting each step as
+    soon as the steps it depends on have finished, so the total time tracks
+    the slowest chain of dependent steps rather than the sum of all of them.
+
+    If a step fails no further steps are started; steps already running are
+    allowed to finish and the first failure is re-raised.
+    """
+
+    def __init__(self):
+        self.steps = collections.OrderedDict()
+
+    def add(self, name, func, requires=(), inputs=None):
+        """
+        ``inputs`` maps keyword arguments of ``func`` to the names of the
+        steps whose results they should be given; those steps are required
+        too.
+        """
+        inputs = inputs or {}
+        self.steps[name] = {
+            'func': func,
+            'inputs': inputs,
+            'requires': set(requires) | set(inputs.values()),
+        }
+
+    def run(self, workers=None):
+        self.validate()
+        pending = collections.OrderedDict(self.steps)
+        running = set()
+        results = {}
+        failures = []
+        condition = threading.Condition()
+
+        def run_step(name, kwargs):
+            """
+            Fabric's abort() raises SystemExit, so anything a step raises
+            counts as a failure, and the step always reports back.
+            """
+            outcome = (False, None)
+            try:
+                with tracing.span(name, category='step'):
+                    result = self.steps[name]['func'](**kwargs)
+                outcome = (True, result)
+            except BaseException as e:
+                utils.failure('%s failed' % name)
+                traceback.print_exc()
+                outcome = (False, e)
+            finally:
+                try:
+                    tracing.tracer.close_phase()
+                    pool.connection_pool.release()
+                finally:
+                    with condition:
+                        running.discard(name)
+                        if outcome[0]:
+                            results[name] = outcome[1]
+                        else:
+                            failures.append(outcome[1] or TaskGraphError(
+                                '%s failed' % name))
+                        condition.notify()
+
+        thread_pool = ThreadPool(processes=workers or pool.pool_size())
+        try:
+            with condition:
+                while True:
+                    if not failures:
+                        for name, step in list(pending.items()):
+                            if not step['requires'].issubset(results):
+                                continue
+                            del pending[name]
+                            running.add(name)
+                            kwargs = dict(
+                                (argument, results[step_name])
+                                for argument, step_name
+                                in step['inputs'].items())
+                            thread_pool.apply_async(run_step, (name, kwargs))
+                    if not running:
+                        break
+                    # A timeout keeps the main thread responsive to Ctrl-C
+                    condition.wait(1)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+
+        if failures:
+            if pending:
+                utils.failure('Cancelled %s' % ', '.join(pending))
+            raise failures[0]
+        return results
+
+    def validate(self):
+        for name, step in self.steps.items():
+            unknown = step['requires'] - set(self.steps)
+            if unknown:
+                raise TaskGraphError('%s requires unknown steps: %s' % (
+                    name, ', '.join(sorted(unknown))))
+
+        # Kahn's algorithm, anything left over is part of a cycle
+        satisfied = set()
+        remaining = dict(self.steps)
+        while remaining:
+            ready = [
+                name
+                for name, step in remaining.items()
+                if step['requires'].issubset(satisfied)
+            ]
+            if not ready:
+                raise TaskGraphError('Steps form a cycle: %s' % ', '.join(
+                    sorted(remaining)))
+            for name in ready:
+                satisfied.add(name)
+                del remaining[name]
@@ -0,0 +1,127 @@
+import itertools
+import collections
+
+from fabconfig import env
+
+"""
+DescribeAutoScalingGroups returns at most 100 groups per page, anything past
+that has to be fetched with the NextToken of the previous page.
+"""
+PAGE_SIZE = 100
+
+
+class GroupInventory(object):
+    """
+    An in-memory copy of the account's Auto Scaling groups, indexed by their
+    (env, type) tags.
+
+    Every page of groups is streamed from the API once, the first time the
+    inventory is queried. After that lookups are served from memory, tag
+    writes are applied to the cached groups and single groups can be
+    re-fetched by name when we need their latest instance list.
+    """
+
+    def __init__(self):
+        self.groups = None
+        self.index = None
+        self.positions = None
+        self.counter = itertools.count()
+
+    def load(self):
+        self.groups = {}
+        self.index = collections.defaultdict(set)
+        self.positions = {}
+        for group in self.stream():
+            self.add(group)
+
+    def stream(self, names=None):
+        next_token = None
+        while True:
+            page = env.connections.autoscale.get_all_groups(
+                names=names, max_records=PAGE_SIZE, next_token=next_token)
+            for group in page:
+                yield group
+            next_token = page.next_token
+            if not next_token:
+                return
+
+    def ensure_loaded(self):
+        if self.groups is None:
+            self.load()
+
+    def find(self, environment, asg_type):
+        self.ensure_loaded()
+        names = sorted(self.index[(environment, asg_type)],
+                       key=self.positions.get)
+        return [self.groups[name] for name in names]
+
+    def all(self):
+        self.ensure_loaded()
+        return sorted(self.groups.values(),
+                      key=lambda group: self.positions[group.name])
+
+    def in_environment(self, environment):
+        self.ensure_loaded()
+        names = sorted(
+            (name
+             for (group_env, group_type), group_names in self.index.items()
+             if group_env == environment
+             for name in group_names),
+            key=self.positions.get)
+        return [self.groups[name] for name in names]
+
+    def refresh(self, name):
+        if self.groups is None:
+            self.load()
+            return self.groups.get(name)
+        groups = list(self.stream(names=[name]))
+        if not groups:
+            self.forget(name)
+            return None
+        self.add(groups[0])
+        return groups[0]
+
+    def add(self, group):
+        self.unindex(group.name)
+        self.groups[group.name] = group
+        if group.name not in self.positions:
+            self.positions[group.name] = next(self.counter)
+        self.index[index_key(group)].add(group.name)
+
+    def forget(self, name):
+        if self.groups is None:
+            return
+        self.unindex(name)
+        self.groups.pop(name, None)
+        self.positions.pop(name, None)
+
+    def unindex(self, name):
+        group = self.groups.get(name)
+        if group is not None:
+            self.index[index_key(group)].discard(name)
+
+    def update_tag(self, tag):
+        """
+        Apply a tag we've just written to the cached copy of its group so the
+        index reflects the change without going back to the API.
+        """
+        if self.groups is None or tag.resource_id not in self.groups:
+            return
+        self.unindex(tag.resource_id)
+        group = self.groups[tag.resource_id]
+        group.tags = [
+            existing_tag
+            for existing_tag in group.tags or []
+            if existing_tag.key != tag.key
+        ] + [tag]
+        self.index[index_key(group)].add(group.name)
+
+    def clear(self):
+        self.groups = None
+        self.index = None
+        self.positions = None
+
+
+def index_key(group):
+    tags = dict((tag.key, tag.value) for tag in group.tags or [])
+    return tags.get('env'), tags.get('type')
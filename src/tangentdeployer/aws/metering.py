@@ -0,0 +1,216 @@
+import os
+import re
+import json
+import time
+import threading
+
+"""
+Error codes AWS uses to tell us we're sending requests too quickly.
+"""
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestLimitExceeded',
+    'PriorRequestNotComplete',
+    'SlowDown',
+])
+
+"""
+Upper bounds (in milliseconds) of the latency histogram buckets, anything
+slower goes in a final overflow bucket.
+"""
+LATENCY_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+QUERY_SERVICES = frozenset(['ec2', 'elb', 'autoscale', 'cloudwatch'])
+
+ERROR_CODE_PATTERN = re.compile(r'<Code>([^<]+)</Code>')
+
+
+class Meter(object):
+    """
+    Counts the AWS API calls a task makes per service and operation, along
+    with their latency, errors, throttling and retries.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def operation(self, service, operation):
+        key = (service, operation)
+        if key not in self.operations:
+            self.operations[key] = {
+                'calls': 0,
+                'errors': 0,
+                'throttled': 0,
+                'retries': 0,
+                'total_ms': 0.0,
+                'max_ms': 0.0,
+                'histogram': [0] * (len(LATENCY_BUCKETS) + 1),
+            }
+        return self.operations[key]
+
+    def record(self, service, operation, milliseconds, error_code=None,
+               attempts=1):
+        bucket = len(
+            [bound for bound in LATENCY_BUCKETS if bound < milliseconds])
+        with self.lock:
+            stats = self.operation(service=service, operation=operation)
+            stats['calls'] += 1
+            stats['retries'] += max(attempts - 1, 0)
+            stats['total_ms'] += milliseconds
+            stats['max_ms'] = max(stats['max_ms'], milliseconds)
+            stats['histogram'][bucket] += 1
+            if error_code:
+                stats['errors'] += 1
+            if error_code in THROTTLING_ERROR_CODES:
+                stats['throttled'] += 1
+
+    def record_throttled(self, service, operation):
+        """
+        A throttled attempt that was retried. The call itself is recorded
+        once it's done, with its final outcome.
+        """
+        with self.lock:
+            self.operation(service=service, operation=operation)[
+                'throttled'] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'latency_buckets_ms': LATENCY_BUCKETS,
+                'operations': [
+                    dict(stats, service=service, operation=operation)
+                    for (service, operation), stats
+                    in sorted(self.operations.items())
+                ],
+            }
+
+    def report(self):
+        row = '%-10s %-32s %6s %6s %9s %7s %8s %8s %8s'
+        lines = [row % ('Service', 'Operation', 'Calls', 'Errors',
+                        'Throttled', 'Retries', 'Mean ms', 'p95 ms',
+                        'Max ms')]
+        totals = [0, 0, 0, 0]
+        for stats in self.as_dict()['operations']:
+            lines.append(row % (
+                stats['service'],
+                stats['operation'][:32],
+                stats['calls'],
+                stats['errors'],
+                stats['throttled'],
+                stats['retries'],
+                '%.0f' % (stats['total_ms'] / stats['calls']),
+                percentile(stats=stats, fraction=0.95),
+                '%.0f' % stats['max_ms']))
+            for index, field in enumerate(
+                    ['calls', 'errors', 'throttled', 'retries']):
+                totals[index] += stats[field]
+        lines.append(row % tuple(['Total', ''] + totals + ['', '', '']))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as metrics_file:
+            json.dump(self.as_dict(), metrics_file, indent=2)
+
+
+meter = Meter()
+
+
+def percentile(stats, fraction):
+    """
+    The upper bound of the histogram bucket the percentile falls in, or the
+    slowest call if that's in the overflow bucket.
+    """
+    target = fraction * stats['calls']
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, stats['histogram']):
+        seen += count
+        if count and seen >= target:
+            return '<%d' % bound
+    return '%.0f' % stats['max_ms']
+
+
+def instrument(connection, service):
+    """
+    Meter every request a boto connection makes, including the ones made by
+    objects it returned (groups, instances, keys...) since they hold on to
+    the same connection.
+
+    boto signs a request again before every attempt, so counting signatures
+    tells us how many attempts a call took, whether boto or the rate limiter
+    retried it.
+    """
+    make_request = connection.make_request
+    add_auth = connection._auth_handler.add_auth
+    attempts = [0]
+
+    def counted_add_auth(*args, **kwargs):
+        attempts[0] += 1
+        return add_auth(*args, **kwargs)
+
+    def metered_make_request(*args, **kwargs):
+        operation = operation_name(service=service, args=args, kwargs=kwargs)
+        attempts[0] = 0
+        start = time.time()
+        error_code = None
+        try:
+            response = make_request(*args, **kwargs)
+        except Exception as e:
+            error_code = e.__class__.__name__
+            raise
+        else:
+            error_code = response_error_code(response)
+            return response
+        finally:
+            meter.record(
+                service=service,
+                operation=operation,
+                milliseconds=(time.time() - start) * 1000,
+                error_code=error_code,
+                attempts=attempts[0])
+
+    connection._auth_handler.add_auth = counted_add_auth
+    connection.make_request = metered_make_request
+    return connection
+
+
+def operation_name(service, args, kwargs):
+    if service in QUERY_SERVICES:
+        return args[0] if args else kwargs.get('action')
+
+    method = args[0] if args else kwargs.get('method', kwargs.get('action'))
+    if service == 's3':
+        key = args[2] if len(args) > 2 else kwargs.get('key')
+        return '%s %s' % (method, 'Object' if key else 'Bucket')
+
+    # Route53 is REST, so name the operation after the resource types in
+    # the path, e.g. POST /2013-04-01/hostedzone/Z123/rrset becomes
+    # POST hostedzone/rrset
+    path = args[1] if len(args) > 1 else kwargs.get('path', '')
+    resources = [
+        part for part in path.split('/') if part.isalpha() and part.islower()]
+    return '%s %s' % (method, '/'.join(resources))
+
+
+def response_error_code(response):
+    """
+    The AWS error code of a failed response. boto caches the body of a
+    response the first time it's read, so reading it here doesn't stop the
+    caller from parsing it.
+    """
+    if response is None or response.status < 400:
+        return None
+    match = ERROR_CODE_PATTERN.search(response.read() or '')
+    if match:
+        return match.group(1)
+    return str(response.status)
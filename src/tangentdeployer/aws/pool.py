@@ -0,0 +1,104 @@
+import tracing
+import metering
+import throttling
+import threading
+import collections
+
+from importlib import import_module
+from multiprocessing.pool import ThreadPool
+from fabconfig import env
+
+"""
+How many worker threads concurrent_map runs by default, which is also how
+many idle connections we keep per service and region.
+"""
+DEFAULT_POOL_SIZE = 8
+
+
+class ConnectionPool(object):
+    """
+    boto connections aren't safe to share between threads, so every thread
+    gets its own connection per service and region.
+
+    Worker threads hand their connections back when they finish a job and
+    the next job to need that service picks one up again, keeping its HTTP
+    keep-alive sockets warm instead of reconnecting.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = collections.defaultdict(list)
+        self.local = threading.local()
+
+    def get(self, service_name, region):
+        connections = self.thread_connections()
+        key = (service_name, region)
+        if key not in connections:
+            with self.lock:
+                idle = self.idle[key]
+                connection = idle.pop() if idle else None
+            if connection is None:
+                connection = self.connect(
+                    service_name=service_name, region=region)
+            connections[key] = connection
+        return connections[key]
+
+    def connect(self, service_name, region):
+        """
+        Metering goes outside the rate limiter, so a call it retries is
+        still metered as one call, with the extra attempts as its retries.
+        """
+        service = service_name.split('.')[-1]
+        connection = self.open(service_name=service_name, region=region)
+        connection = throttling.limit(connection=connection, service=service)
+        return metering.instrument(connection=connection, service=service)
+
+    def open(self, service_name, region):
+        """
+        Open a new boto connection. The offline benchmarks replace this to
+        point the connections at a fake AWS backend.
+        """
+        service = import_module(service_name)
+        return service.connect_to_region(
+            region, profile_name=env.profile_name)
+
+    def thread_connections(self):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def release(self):
+        connections = self.thread_connections()
+        with self.lock:
+            for key, connection in connections.items():
+                if len(self.idle[key]) < pool_size():
+                    self.idle[key].append(connection)
+        connections.clear()
+
+
+connection_pool = ConnectionPool()
+
+
+def pool_size():
+    return env.get('connection_pool_size', DEFAULT_POOL_SIZE)
+
+
+def concurrent_map(func, items, workers=None):
+    """
+    Like map(), but runs ``func`` on a pool of worker threads which can use
+    ``env.connections`` safely. Returns the results in order and re-raises
+    the first exception.
+    """
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            tracing.tracer.close_phase()
+            connection_pool.release()
+
+    thread_pool = ThreadPool(processes=workers or pool_size())
+    try:
+        return thread_pool.map(run, items)
+    finally:
+        thread_pool.close()
+        thread_pool.join()
@@ -1,67 +1,160 @@
-import time
+import ec2
 import utils
-from . import ec2
+import waiter
 
 from fabconfig import env
 
+"""
+ChangeResourceRecordSets limits: at most 1000 resource records and 32000
+characters of record values per request, with UPSERTs counting twice.
+"""
+MAX_RECORDS_PER_BATCH = 1000
+MAX_CHARACTERS_PER_BATCH = 32000
+
+zones = {}
+
+
+def get_zone(zone_name=None):
+    zone_name = zone_name or env.zone
+    if zone_name not in zones:
+        zones[zone_name] = env.connections.route53.get_zone(zone_name)
+    return zones[zone_name]
+
+
+class ChangeBatch(object):
+    """
+    Collects the record changes of a deploy phase and commits them in as few
+    ChangeResourceRecordSets requests as the API limits allow, then waits
+    once for all of them to be INSYNC.
+    """
+
+    def __init__(self, zone=None):
+        self.zone = zone or get_zone()
+        self.changes = []
+
+    def upsert_cname(self, name, value, ttl):
+        self.changes.append({
+            'name': qualified(name),
+            'type': 'CNAME',
+            'ttl': ttl,
+            'values': [value],
+        })
+
+    def upsert_alias(self, name, type, alias_dns_name, alias_hosted_zone_id,
+                     alias_evaluate_target_health=False):
+        self.changes.append({
+            'name': qualified(name),
+            'type': type,
+            'alias_dns_name': alias_dns_name,
+            'alias_hosted_zone_id': alias_hosted_zone_id,
+            'alias_evaluate_target_health': alias_evaluate_target_health,
+            'values': [],
+        })
+
+    def change_sets(self):
+        from boto.route53.record import ResourceRecordSets
+        change_set, records, characters = None, 0, 0
+        for change in self.changes:
+            change_records = 2 * max(len(change['values']), 1)
+            change_characters = 2 * sum(len(v) for v in change['values'])
+            if change_set is None or \
+                    records + change_records > MAX_RECORDS_PER_BATCH or \
+                    characters + change_characters > MAX_CHARACTERS_PER_BATCH:
+                if change_set is not None:
+                    yield change_set
+                change_set = ResourceRecordSets(
+                    connection=env.connections.route53,
+                    hosted_zone_id=self.zone.id)
+                records, characters = 0, 0
+            record = change_set.add_change(
+                'UPSERT',
+                change['name'],
+                type=change['type'],
+                ttl=change.get('ttl', 600),
+                alias_dns_name=change.get('alias_dns_name'),
+                alias_hosted_zone_id=change.get('alias_hosted_zone_id'),
+                alias_evaluate_target_health=change.get(
+                    'alias_evaluate_target_health', False))
+            for value in change['values']:
+                record.add_value(value)
+            records += change_records
+            characters += change_characters
+        if change_set is not None:
+            yield change_set
+
+    def commit(self, wait=True):
+        from boto.route53.status import Status
+        if not self.changes:
+            return
+        utils.status('Committing %d DNS record changes' % len(self.changes))
+        statuses = [
+            Status(env.connections.route53,
+                   change_set.commit()['ChangeResourceRecordSetsResponse']
+                                      ['ChangeInfo'])
+            for change_set in self.change_sets()
+        ]
+        self.changes = []
+        if wait:
+            waiter.wait(
+                poll=lambda: [
+                    status.update() if status.status != 'INSYNC'
+                    else status.status
+                    for status in statuses
+                ],
+                ready=lambda status: status == 'INSYNC',
+                description='DNS changes')
+
+
+def qualified(name):
+    name = name.strip()
+    if name.endswith('.'):
+        return name
+    return name + '.'
+
 
 def link_qa_urls(autoscaling_group):
     utils.status("Linking the QA URLs to the new instances")
-    route53_zone = env.connections.route53.get_zone(env.zone)
+    change_batch = ChangeBatch()
 
-    for index, instance in enumerate(autoscaling_group.instances):
-        utils.status('Waiting on a public DNS name for instances')
-        instance_obj = ec2.get(instance_id=instance.instance_id)
-        while not instance_obj.dns_name:
-            time.sleep(1)
-            instance_obj = ec2.get(instance_id=instance.instance_id)
-        [
-            route53_zone.update_cname(
+    utils.status('Waiting on a public DNS name for instances')
+    instance_objs = ec2.wait_for_dns_names(autoscaling_group=autoscaling_group)
+    for index, instance_obj in enumerate(instance_objs):
+        for qa_url in env.qa_urls:
+            change_batch.upsert_cname(
                 name=qa_url % str(index + 1),
                 value=instance_obj.dns_name,
-                ttl=env.ttl_in_seconds
-            )
-            for qa_url
-            in env.qa_urls
-        ]
+                ttl=env.ttl_in_seconds)
+    change_batch.commit()
     utils.success('Finished linking the instances to the QA URLs')
 
 
 def link_base_urls(load_balancer):
     utils.status('Link base URLs')
-    route53_zone = env.connections.route53.get_zone(env.zone)
-
-    # We have to operate on rrsets because the main url can't be
-    # changed with CNAME
-    rrsets = env.connections.route53.get_all_rrsets(
-        hosted_zone_id=route53_zone.id,
-        name=env.zone,
-        type='A'
-    )
-    rrsets.add_change(
-        'UPSERT',
-        env.base_url,
+    change_batch = ChangeBatch()
+
+    # The main url can't be a CNAME so it's an alias A record
+    change_batch.upsert_alias(
+        name=env.base_url,
         type='A',
         alias_dns_name=load_balancer.dns_name,
         alias_hosted_zone_id=load_balancer.canonical_hosted_zone_name_id,
-        alias_evaluate_target_health=False
-    )
-    rrsets.commit()
+        alias_evaluate_target_health=False)
     for url in env.urls:
-        route53_zone.update_cname(
+        change_batch.upsert_cname(
             name=url,
             value=load_balancer.dns_name,
-            ttl=env.ttl_in_seconds
-        )
+            ttl=env.ttl_in_seconds)
+    change_batch.commit()
 
 
 def unlink_qa_urls(autoscaling_group):
     utils.status('Un-linking QA URLs')
-    route53_zone = env.connections.route53.get_zone(env.zone)
+    change_batch = ChangeBatch()
     for index, instance in enumerate(autoscaling_group.instances):
-        route53_zone.update_cname(
-            name=env.qa_url % str(index + 1),
-            value='NOQA.',
-            ttl=env.ttl_in_seconds
-        )
+        for qa_url in env.qa_urls:
+            change_batch.upsert_cname(
+                name=qa_url % str(index + 1),
+                value='NOQA.',
+                ttl=env.ttl_in_seconds)
+    change_batch.commit()
     utils.success('Finished un-linking URLs')
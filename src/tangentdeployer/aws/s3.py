@@ -1,25 +1,111 @@
+import io
 import os
+import gzip
+import json
+import pool
+import hashlib
+import tarfile
 import utils
+import templating
 
-from jinja2 import Template
 from fabconfig import env
 
+"""
+Where bundles of the rendered bootstrap folder are kept, under the folder's
+own prefix in the bucket. Each bundle is named after its contents.
+"""
+BUNDLE_FOLDER = 'bundles'
+
 
 def push_config_to_s3():
+    """
+    Render the bootstrap folder and upload whatever differs from what's
+    already in the bucket. Keys are compared by the MD5 of their rendered
+    contents against the ETags from a single bucket listing, and changed
+    keys are uploaded concurrently with their ACL set in the same PUT.
+
+    The rendered folder is also published as a single versioned bundle with
+    a manifest next to it, which instances fetch in one request. Its key is
+    left in ``env.bootstrap_bundle`` for the user data.
+    """
     utils.status('Pushing %(environment)s config to S3' % env)
+    # The bundle is rendered without a previous push's key in it, otherwise
+    # a second push in the same run would bundle different user data
+    env.pop('bootstrap_bundle', None)
     bucket = env.connections.s3.get_bucket(env.s3_bootstrap_bucket)
+    prefix = os.path.join(env.environment, env.bootstrap_folder, '')
+    remote_etags = dict(
+        (key.name, key.etag.strip('"'))
+        for key in bucket.list(prefix=prefix)
+    )
+
+    changed_keys = []
+    bootstrap_files = []
     for (dirpath, dirname, filenames) in os.walk(env.bootstrap_folder):
         for filename in filenames:
             filepath = os.path.join(dirpath, filename)
             key_name = os.path.join(env.environment, filepath)
-            key = bucket.new_key(key_name)
-            contents = get_bootstrap_file(filepath)
-            key.set_contents_from_string(contents)
-            key.set_acl('authenticated-read')
+            contents = get_bootstrap_file(filepath).encode('utf-8')
+            bootstrap_files.append((filepath, contents))
+            if hashlib.md5(contents).hexdigest() == remote_etags.get(key_name):
+                continue
+            changed_keys.append((key_name, contents))
+
+    bundle, manifest = build_bundle(bootstrap_files=bootstrap_files)
+    bundle_key_name = os.path.join(prefix, BUNDLE_FOLDER,
+                                   '%s.tar.gz' % manifest['version'])
+    if bundle_key_name not in remote_etags:
+        changed_keys.append((bundle_key_name[:-len('.tar.gz')] + '.json',
+                             json.dumps(manifest, indent=2, sort_keys=True)))
+        changed_keys.append((bundle_key_name, bundle))
+    env.bootstrap_bundle = bundle_key_name
+
+    if changed_keys:
+        utils.status(
+            'Uploading %d changed bootstrap files' % len(changed_keys))
+        pool.concurrent_map(
+            upload, changed_keys, workers=env.get('s3_upload_workers'))
     utils.success('Finished pushing deploy script to S3')
 
 
+def upload(changed_key):
+    key_name, contents = changed_key
+    bucket = env.connections.s3.get_bucket(
+        env.s3_bootstrap_bucket, validate=False)
+    key = bucket.new_key(key_name)
+    key.set_contents_from_string(contents, policy='authenticated-read')
+
+
+def build_bundle(bootstrap_files):
+    """
+    A gzipped tarball of the rendered bootstrap files, relative to the
+    bootstrap folder, and a manifest of what's in it. Entries carry no
+    timestamps, owners or umask, so the same files always make the same bundle
+    and its version (a hash of its contents) only changes when they do.
+    """
+    archive = io.BytesIO()
+    gzip_file = gzip.GzipFile(
+        filename='', mode='wb', fileobj=archive, mtime=0)
+    files = {}
+    with tarfile.open(fileobj=gzip_file, mode='w') as tar:
+        for filepath, contents in sorted(bootstrap_files):
+            name = os.path.relpath(filepath, env.bootstrap_folder)
+            tar_info = tarfile.TarInfo(name=name)
+            tar_info.size = len(contents)
+            tar_info.mode = 0o755 if os.access(filepath, os.X_OK) else 0o644
+            tar.addfile(tar_info, io.BytesIO(contents))
+            files[name] = {
+                'md5': hashlib.md5(contents).hexdigest(),
+                'size': len(contents),
+            }
+    gzip_file.close()
+    bundle = archive.getvalue()
+    manifest = {
+        'version': hashlib.sha1(bundle).hexdigest(),
+        'files': files,
+    }
+    return bundle, manifest
+
+
 def get_bootstrap_file(file_path):
-    with open(file_path, 'r') as opened_file:
-        template = Template(opened_file.read())
-        return template.render(**env)
+    return templating.render(template_path=file_path, context=env)
@@ -0,0 +1,82 @@
+import io
+import ec2
+import utils
+import autoscale
+
+from fabric.api import execute, parallel
+from fabric.operations import put, sudo
+from fabconfig import env
+
+"""
+How many standby instances we refresh over SSH at once.
+"""
+REFRESH_POOL_SIZE = 10
+
+
+def get_pool():
+    """
+    The Standby group, if it has a full group's worth of instances in
+    service to promote.
+    """
+    autoscaling_group = autoscale.get(asg_type='Standby')
+    if not autoscaling_group:
+        return None
+    in_service = [
+        instance
+        for instance in autoscaling_group.instances
+        if instance.lifecycle_state == 'InService'
+    ]
+    if len(in_service) < env.asg_desired_capacity:
+        utils.status('The standby group only has %d of %d instances ready' %
+                     (len(in_service), env.asg_desired_capacity))
+        return None
+    return autoscaling_group
+
+
+def promote(autoscaling_group):
+    """
+    Turn the standby group into this deploy's QA group. Its instances are
+    already bootstrapped, so all they need is the current config and
+    images, which refresh_instances gives them over SSH rather than booting
+    new ones. That has to happen on the main thread, fabric isn't thread
+    safe, so it's left to the caller.
+    """
+    utils.status('Promoting standby group %s to QA' % autoscaling_group.name)
+    autoscale.replace_launch_configuration(autoscaling_group=autoscaling_group)
+    autoscale.create_scaling_rules(autoscaling_group=autoscaling_group)
+    autoscale.tag(autoscaling_group=autoscaling_group, key='type', value='QA')
+    utils.success('Promoted standby group %s to QA' % autoscaling_group.name)
+    return autoscaling_group
+
+
+def refresh_instances(autoscaling_group):
+    instances = ec2.wait_for_dns_names(autoscaling_group=autoscaling_group)
+    hosts = [
+        '%s@%s' % (env.get('instance_user', 'ubuntu'), instance.dns_name)
+        for instance in instances
+    ]
+    utils.status('Refreshing %d standby instances' % len(hosts))
+    execute(refresh_instance,
+            script=utils.get_app_refresh_script(env=env),
+            hosts=hosts)
+
+
+@parallel(pool_size=REFRESH_POOL_SIZE)
+def refresh_instance(script):
+    remote_script = '/tmp/%(project)s-%(environment)s-refresh.sh' % env
+    put(io.BytesIO(script.encode('utf-8')), remote_script)
+    sudo('sh %s && rm %s' % (remote_script, remote_script))
+
+
+def refill(load_balancer):
+    """
+    Start a new standby group for the next deploy if there isn't one. We
+    don't wait for it, its instances boot and bootstrap in the background.
+    """
+    if autoscale.get(asg_type='Standby'):
+        return None
+    utils.status('Refilling the standby pool')
+    autoscaling_group = autoscale.create_autoscaling_group(
+        load_balancer=load_balancer, asg_type='Standby', wait=False)
+    utils.success('Started standby group %s' % autoscaling_group.name)
+    return autoscaling_group
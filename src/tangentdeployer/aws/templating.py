@@ -0,0 +1,86 @@
+import os
+import json
+import hashlib
+import threading
+
+from fabconfig import env
+
+"""
+Every bootstrap, user data and nagios template is rendered through a single
+Jinja environment. Compiled templates are kept in memory and as bytecode on
+disk, and Jinja re-checks each template's mtime before reusing it.
+
+Renders are memoized on the values of just the variables a template
+references, so re-rendering a template whose inputs haven't changed is a
+dictionary lookup. They're only kept in memory, rendered files like
+dockercfg hold credentials.
+"""
+jinja_environment = None
+environment_lock = threading.Lock()
+template_info = {}
+renders = {}
+
+
+def render(template_path, context):
+    """
+    ``template_path`` can be absolute or relative to the working directory.
+    """
+    template_path = os.path.abspath(template_path)
+    environment = get_environment()
+    names, source_digest = get_template_info(
+        environment=environment, template_path=template_path)
+    template_context = dict(
+        (name, context[name]) for name in names if name in context)
+
+    key = render_key(source_digest=source_digest, context=template_context)
+    if key not in renders:
+        template = environment.get_template(template_path)
+        renders[key] = template.render(**template_context)
+    return renders[key]
+
+
+def get_environment():
+    """
+    Deploy steps render from worker threads, so only one of them sets the
+    environment up.
+    """
+    from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+    global jinja_environment
+    with environment_lock:
+        if jinja_environment is None:
+            bytecode_dir = os.path.join(cache_dir(), 'bytecode')
+            if not os.path.isdir(bytecode_dir):
+                os.makedirs(bytecode_dir)
+            jinja_environment = Environment(
+                loader=FileSystemLoader('/'),
+                bytecode_cache=FileSystemBytecodeCache(bytecode_dir),
+                auto_reload=True)
+    return jinja_environment
+
+
+def get_template_info(environment, template_path):
+    """
+    The variables a template references and a digest of its source, only
+    recomputed when the template's mtime changes.
+    """
+    from jinja2 import meta
+    mtime = os.path.getmtime(template_path)
+    cached = template_info.get(template_path)
+    if cached is None or cached[0] != mtime:
+        source = environment.loader.get_source(environment, template_path)[0]
+        names = meta.find_undeclared_variables(environment.parse(source))
+        source_digest = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        cached = template_info[template_path] = (
+            mtime, sorted(names), source_digest)
+    return cached[1], cached[2]
+
+
+def render_key(source_digest, context):
+    key = hashlib.sha1(source_digest.encode('utf-8'))
+    key.update(
+        json.dumps(context, sort_keys=True, default=repr).encode('utf-8'))
+    return key.hexdigest()
+
+
+def cache_dir():
+    return env.get('template_cache_dir', '.template-cache')
@@ -0,0 +1,177 @@
+import time
+import random
+import metering
+import threading
+
+from fabconfig import env
+
+"""
+Requests per second we start each service at. The limiters adapt from here
+to whatever the account allows, up to MAX_RATE_MULTIPLIER times faster.
+Override per service with ``env.api_rate_limits``.
+"""
+DEFAULT_RATES = {
+    'ec2': 20.0,
+    'elb': 10.0,
+    'autoscale': 10.0,
+    'cloudwatch': 10.0,
+    'route53': 5.0,
+    's3': 50.0,
+}
+DEFAULT_RATE = 10.0
+MAX_RATE_MULTIPLIER = 4
+MIN_RATE = 0.5
+
+"""
+Transient server side errors worth another go, on top of throttling.
+"""
+RETRYABLE_ERROR_CODES = frozenset([
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+])
+
+DEFAULT_MAX_ATTEMPTS = 8
+
+"""
+Retry delays in seconds: exponential from RETRY_BASE_DELAY up to
+RETRY_MAX_DELAY, with full jitter. Throttling backs off from a higher base
+since the whole account is over its limit, not just this request.
+"""
+RETRY_BASE_DELAY = 0.25
+THROTTLED_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 20.0
+
+
+class RateLimiter(object):
+    """
+    A token bucket whose rate adapts AIMD style, like TCP congestion
+    control: every successful request adds 1/rate requests per second, so
+    a limiter running flat out speeds up by one request per second each
+    second, and a throttled request halves the rate. Requests sent before
+    the last halving don't halve it again, otherwise a burst of concurrent
+    requests throttled together would cut the rate to the floor.
+
+    Every worker thread using a service shares its limiter, which is what
+    keeps concurrent steps from throttling each other.
+    """
+
+    def __init__(self, rate, max_rate, min_rate=MIN_RATE):
+        self.lock = threading.Lock()
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.min_rate = float(min_rate)
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.decreased = 0
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is free, and return the time the
+        request was let through. Tokens are reserved under the lock and
+        slept for outside it, so waiting threads queue up in order without
+        blocking each other.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(
+                max(self.rate, 1.0),
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return now + wait
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+
+    def throttled(self, sent):
+        with self.lock:
+            if sent < self.decreased:
+                return
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.decreased = time.time()
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def limiter(service):
+    with limiters_lock:
+        if service not in limiters:
+            rate = env.get('api_rate_limits', {}).get(
+                service, DEFAULT_RATES.get(service, DEFAULT_RATE))
+            limiters[service] = RateLimiter(
+                rate=rate, max_rate=rate * MAX_RATE_MULTIPLIER)
+        return limiters[service]
+
+
+def limit(connection, service):
+    """
+    Rate limit every request a boto connection makes through the service's
+    shared limiter, and retry the ones AWS throttles or fails transiently.
+
+    Uploads that stream from a file (``sender``) can't be replayed, so
+    they're rate limited but never retried here.
+    """
+    from boto.exception import BotoServerError
+    make_request = connection.make_request
+
+    def limited_make_request(*args, **kwargs):
+        service_limiter = limiter(service)
+        max_attempts = env.get('api_max_attempts', DEFAULT_MAX_ATTEMPTS)
+        attempt = 1
+        while True:
+            sent = service_limiter.acquire()
+            try:
+                response = make_request(*args, **kwargs)
+            except BotoServerError as e:
+                # boto raises instead of returning once its own retries of
+                # a 5xx response run out
+                error_code = e.error_code
+                response = None
+                error = e
+            else:
+                error_code = metering.response_error_code(response)
+                error = None
+
+            if error_code in metering.THROTTLING_ERROR_CODES:
+                service_limiter.throttled(sent=sent)
+            elif error is None:
+                service_limiter.succeeded()
+
+            if not retryable(error_code) or 'sender' in kwargs or \
+                    attempt >= max_attempts:
+                if error is not None:
+                    raise error
+                return response
+
+            if error_code in metering.THROTTLING_ERROR_CODES:
+                metering.meter.record_throttled(
+                    service=service,
+                    operation=metering.operation_name(
+                        service=service, args=args, kwargs=kwargs))
+            time.sleep(retry_delay(attempt=attempt, error_code=error_code))
+            attempt += 1
+
+    connection.make_request = limited_make_request
+    return connection
+
+
+def retryable(error_code):
+    return error_code in metering.THROTTLING_ERROR_CODES or \
+        error_code in RETRYABLE_ERROR_CODES
+
+
+def retry_delay(attempt, error_code):
+    if error_code in metering.THROTTLING_ERROR_CODES:
+        base_delay = THROTTLED_BASE_DELAY
+    else:
+        base_delay = RETRY_BASE_DELAY
+    return random.uniform(
+        0, min(RETRY_MAX_DELAY, base_delay * 2 ** (attempt - 1)))
@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import threading
+import contextlib
+
+"""
+Timed spans for the phases of a task, written out as a Chrome trace
+(load it in chrome://tracing or https://ui.perfetto.dev) plus a summary
+table of where the time went.
+"""
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.spans = []
+        self.local.phase = None
+
+    def open_phase(self, name):
+        """
+        Start a phase on this thread that runs until the next phase starts
+        or close_phase is called.
+        """
+        self.close_phase()
+        self.local.phase = (name, time.time())
+
+    def close_phase(self):
+        phase = getattr(self.local, 'phase', None)
+        if phase is None:
+            return
+        self.local.phase = None
+        self.record(
+            name=phase[0], category='status', start=phase[1], end=time.time())
+
+    def record(self, name, category, start, end):
+        thread = threading.current_thread()
+        with self.lock:
+            self.spans.append({
+                'name': name,
+                'category': category,
+                'start': start,
+                'end': end,
+                'thread_id': thread.ident,
+                'thread_name': thread.name,
+            })
+
+    def chrome_trace(self):
+        with self.lock:
+            spans = list(self.spans)
+        pid = os.getpid()
+        thread_names = dict(
+            (span['thread_id'], span['thread_name']) for span in spans)
+        events = [
+            {
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': thread_id,
+                'args': {'name': thread_name},
+            }
+            for thread_id, thread_name in thread_names.items()
+        ]
+        events.extend(
+            {
+                'name': span['name'],
+                'cat': span['category'],
+                'ph': 'X',
+                'pid': pid,
+                'tid': span['thread_id'],
+                'ts': int((span['start'] - self.started) * 1000000),
+                'dur': int((span['end'] - span['start']) * 1000000),
+            }
+            for span in spans
+        )
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def summary(self):
+        """
+        One row per span name: how many times it ran, the total time spent
+        in it and that time as a share of the whole task. Spans nest, so the
+        shares don't add up to 100%.
+        """
+        with self.lock:
+            spans = list(self.spans)
+        elapsed = max([span['end'] for span in spans] or [self.started]) - \
+            self.started
+        totals = {}
+        for span in spans:
+            count, total = totals.get(span['name'], (0, 0))
+            totals[span['name']] = (
+                count + 1, total + span['end'] - span['start'])
+
+        name_width = max([len(name) for name in totals] + [len('Phase')])
+        row = '%-' + str(name_width) + 's %6s %10s %7s'
+        lines = [row % ('Phase', 'Count', 'Seconds', 'Share')]
+        for name, (count, total) in sorted(
+                totals.items(), key=lambda item: -item[1][1]):
+            lines.append(row % (
+                name,
+                count,
+                '%.1f' % total,
+                '%.0f%%' % (100 * total / elapsed if elapsed else 0)))
+        return '\n'.join(lines)
+
+    def write(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as trace_file:
+            json.dump(self.chrome_trace(), trace_file)
+
+
+tracer = Tracer()
+
+
+@contextlib.contextmanager
+def span(name, category='phase'):
+    start = time.time()
+    try:
+        yield
+    finally:
+        tracer.record(
+            name=name, category=category, start=start, end=time.time())
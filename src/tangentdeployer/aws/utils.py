@@ -1,11 +1,28 @@
-from jinja2 import Template
-from importlib import import_module
+import os
+import time
+import pool
+import tracing
+import metering
+import functools
+import threading
+import templating
 
 from fabric.colors import green, red, yellow
 from fabconfig import env
 
 
 class BotoConnection(object):
+    """
+    Connections to the AWS services a deploy uses, e.g.
+    ``env.connections.ec2``.
+
+    Connecting means importing the boto module and resolving credentials,
+    so it's put off until a service is first used. Tasks like ``fab --list``
+    don't connect to anything and a task only connects to what it uses.
+
+    Each thread gets its own connection from the connection pool, so
+    ``env.connections`` can be used from ``pool.concurrent_map`` workers.
+    """
 
     def __new__(cls, profile_name, services):
         if not hasattr(cls, '__instance__'):
@@ -15,55 +32,135 @@ class BotoConnection(object):
         return cls.__instance__
 
     def __init__(self, profile_name, services):
-        self.__connect_to_boto_services(profile_name, services)
+        self.__services = self.__service_modules(services)
 
-    def __connect_to_boto_services(self, profile_name, services):
+    def __service_modules(self, services):
+        service_modules = {}
         for service_name in services:
             attribute_name = service_name.split('.')[-1]
 
-            if hasattr(self, attribute_name):
+            if attribute_name in service_modules:
                 raise Exception("'%s' service connection already exists. Did "
                                 "you define the same service twice, or have "
                                 "two services with the same module "
                                 "name?" % attribute_name)
 
-            service = import_module(service_name)
-            connection = service.connect_to_region(
-                env.region, profile_name=env.profile_name)
-            setattr(self, attribute_name, connection)
+            service_modules[attribute_name] = service_name
+        return service_modules
+
+    def __getattr__(self, attribute_name):
+        service_modules = self.__dict__.get('_BotoConnection__services', {})
+        if attribute_name not in service_modules:
+            raise AttributeError(attribute_name)
+        return pool.connection_pool.get(
+            service_name=service_modules[attribute_name], region=env.region)
+
+
+"""
+Steps running on worker threads print too, so each box is printed whole.
+"""
+message_lock = threading.Lock()
 
 
 def message(color, msg):
     bar = '+' + '-' * (len(msg) + 2) + '+'
-    print(color(''))
-    print(color(bar))
-    print(color("| %s |" % msg))
-    print(color(bar))
-    print(color(''))
+    with message_lock:
+        print(color(''))
+        print(color(bar))
+        print(color("| %s |" % msg))
+        print(color(bar))
+        print(color(''))
 
 
 def success(msg):
     message(green, msg)
+    tracing.tracer.close_phase()
 
 
 def failure(msg):
     message(red, msg)
+    tracing.tracer.close_phase()
 
 
 def status(msg):
+    """
+    Each status starts a timed phase on the current thread which lasts until
+    the next status, success or failure.
+    """
     message(yellow, msg)
+    tracing.tracer.open_phase(msg)
+
+
+def instrumented(task):
+    """
+    Trace and meter the fab task it decorates. When the task finishes (or
+    fails) a Chrome trace of its phases is written to ``env.trace_dir`` and
+    a summary of where the time went is printed, followed by a report of the
+    AWS API calls it made. Set ``env.api_metrics_dir`` to also save the API
+    call report as JSON.
+    """
+    @functools.wraps(task)
+    def wrapper(*args, **kwargs):
+        tracing.tracer.reset()
+        metering.meter.reset()
+        try:
+            with tracing.span(task.__name__, category='task'):
+                return task(*args, **kwargs)
+        finally:
+            tracing.tracer.close_phase()
+            report(task_name=task.__name__)
+    return wrapper
+
+
+def report(task_name):
+    filename = '%s-%s-%s.json' % (task_name,
+                                  env.get('environment', 'none'),
+                                  time.strftime('%Y%m%d-%H%M%S'))
+    trace_path = os.path.join(env.get('trace_dir', 'traces'), filename)
+    tracing.tracer.write(trace_path)
+    print('')
+    print(tracing.tracer.summary())
+    print('Trace written to %s' % trace_path)
+
+    print('')
+    print(metering.meter.report())
+    if env.get('api_metrics_dir'):
+        metrics_path = os.path.join(env.api_metrics_dir, filename)
+        metering.meter.write(metrics_path)
+        print('API call metrics written to %s' % metrics_path)
 
 
 def get_app_user_data(env):
-    user_data = open('bootstrap/app-user-data.sh').read()
-    template = Template(user_data)
-    return template.render(**env)
+    """
+    Instances booting from a baked AMI only need the per deploy part of the
+    bootstrap, anything else runs the bake script first.
+    """
+    user_data = templating.render(
+        template_path='bootstrap/app-user-data.sh', context=env)
+    if env.get('baked_image'):
+        return user_data
+    # Jinja drops the bake script's trailing newline
+    return get_app_bake_script(env=env, pull_images=False) + '\n' + user_data
+
+
+def get_app_bake_script(env, pull_images=True):
+    """
+    Without ``pull_images`` the bake script leaves pulling the images to the
+    user data that follows it, which pulls them all at once.
+    """
+    context = dict(env, pull_images=pull_images)
+    return templating.render(
+        template_path='bootstrap/app-bake.sh', context=context)
+
+
+def get_app_refresh_script(env):
+    return templating.render(
+        template_path='bootstrap/app-refresh.sh', context=env)
 
 
 def get_logging_user_data(env):
-    user_data = open('bootstrap/logging-user-data.sh').read()
-    template = Template(user_data)
-    return template.render(**env)
+    return templating.render(
+        template_path='bootstrap/logging-user-data.sh', context=env)
 
 
 def security_groups():
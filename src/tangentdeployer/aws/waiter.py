@@ -0,0 +1,54 @@
+import time
+import tracing
+import random
+
+from fabconfig import env
+
+
+class WaiterTimeout(Exception):
+    pass
+
+
+def wait(poll, ready, description, timeout=None):
+    """
+    Poll a batch of resources until ``ready`` holds for every one of them and
+    return the final batch.
+
+    ``poll`` is called straight away so we don't sleep at all if the
+    condition already holds. While nothing changes the delay between polls
+    doubles up to ``env.waiter_max_delay``, with jitter so concurrent waiters
+    don't poll in lock-step. As soon as another resource becomes ready the
+    delay drops back to ``env.waiter_delay``, since the rest of the batch is
+    usually close behind.
+    """
+    if timeout is None:
+        timeout = env.get('waiter_timeout', 900)
+    initial_delay = env.get('waiter_delay', 1)
+    max_delay = env.get('waiter_max_delay', 15)
+
+    with tracing.span(description, category='wait'):
+        deadline = time.time() + timeout
+        delay = initial_delay
+        progress = None
+        while True:
+            resources = poll()
+            done = len(
+                [resource for resource in resources if ready(resource)])
+            if resources and done == len(resources):
+                print('%s: %d/%d ready' % (description, done, len(resources)))
+                return resources
+
+            if progress is not None and done > progress[0]:
+                delay = initial_delay
+            if (done, len(resources)) != progress:
+                progress = (done, len(resources))
+                print('%s: %d/%d ready' % (description, done, len(resources)))
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise WaiterTimeout(
+                    '%s: gave up after %ds with %d/%d ready' % (
+                        description, timeout, done, len(resources)))
+            time.sleep(
+                min(remaining, delay / 2.0 + random.uniform(0, delay / 2.0)))
+            delay = min(delay * 2, max_delay)
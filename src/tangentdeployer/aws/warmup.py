@@ -0,0 +1,172 @@
+import re
+import time
+import base64
+import socket
+import httplib
+import collections
+
+import ec2
+import pool
+import utils
+import autoscale
+
+from urllib2 import Request, URLError, urlopen
+from fabric.api import execute
+from fabric.operations import sudo
+from fabconfig import env
+
+"""
+How many requests we have in flight to each QA instance at once.
+"""
+WARM_UP_CONCURRENCY = 4
+
+"""
+An instance is warm once the 90th percentile latency of a round of requests
+to it is under this many milliseconds. We give up on it after
+WARM_UP_MAX_ROUNDS rounds.
+"""
+WARM_UP_LATENCY_THRESHOLD = 250
+WARM_UP_MAX_ROUNDS = 10
+
+"""
+Without ``env.warm_up_urls`` we replay the most requested paths from the end
+of an Active instance's nginx access log.
+"""
+WARM_UP_SAMPLE_SIZE = 50
+ACCESS_LOG = '/var/log/nginx/access.log'
+ACCESS_LOG_LINES = 5000
+
+REQUEST_TIMEOUT = 30
+
+"""
+Only successful GETs are safe to replay, and the load balancer's health
+checks would drown out everything else.
+"""
+ACCESS_LOG_PATTERN = re.compile(r'"GET (\S+) HTTP/[\d.]+" 200 ')
+HEALTH_CHECKER = 'ELB-HealthChecker'
+
+
+def warm_up(autoscaling_group):
+    """
+    Replay requests against each instance in the QA group, through the QA
+    URLs link_qa_urls points at them, until their latency settles. Returns
+    whether every instance got there.
+    """
+    paths = env.get('warm_up_urls') or sample_paths()
+    if not paths:
+        utils.failure('There are no URLs to warm up with, set '
+                      'env.warm_up_urls')
+        return False
+    hosts = [
+        env.qa_urls[0].rstrip('.') % str(index + 1)
+        for index in range(len(autoscaling_group.instances))
+    ]
+    utils.status('Warming up %d QA instances with %d URLs' % (
+        len(hosts), len(paths)))
+    results = pool.concurrent_map(
+        lambda host: warm_up_host(host=host, paths=paths),
+        hosts, workers=len(hosts) or 1)
+    for host, (rounds, latency) in zip(hosts, results):
+        if latency is not None and latency < latency_threshold():
+            utils.success('%s settled at %dms after %d rounds' % (
+                host, latency, rounds))
+        else:
+            utils.failure('%s is still slow after %d rounds' % (host, rounds))
+    return all(
+        latency is not None and latency < latency_threshold()
+        for rounds, latency in results
+    )
+
+
+def warm_up_host(host, paths):
+    """
+    Request every path from one host, ``env.warm_up_concurrency`` at a time,
+    and go again until the round's 90th percentile latency is under the
+    threshold. Returns the number of rounds and the last round's latency,
+    which is None if any request in it failed.
+    """
+    latency = None
+    for rounds in range(1, env.get('warm_up_max_rounds',
+                                   WARM_UP_MAX_ROUNDS) + 1):
+        latencies = pool.concurrent_map(
+            lambda path: fetch(url='http://%s%s' % (host, path)),
+            paths,
+            workers=env.get('warm_up_concurrency', WARM_UP_CONCURRENCY))
+        if None in latencies:
+            latency = None
+            continue
+        latency = percentile(latencies, 90)
+        if latency < latency_threshold():
+            break
+    return rounds, latency
+
+
+def fetch(url):
+    """
+    The time in milliseconds to request and read ``url``, or None if we
+    couldn't. Client errors still count, they've been through the app, but
+    server errors like a 502 from nginx while uWSGI is down don't.
+    """
+    request = Request(url)
+    if env.get('warm_up_auth'):
+        request.add_header('Authorization', 'Basic %s' % base64.b64encode(
+            '%s:%s' % env.warm_up_auth))
+    start = time.time()
+    try:
+        try:
+            response = urlopen(request, timeout=REQUEST_TIMEOUT)
+        except URLError as e:
+            if getattr(e, 'code', 500) >= 500:
+                return None
+            response = e
+        try:
+            response.read()
+        finally:
+            response.close()
+    except (socket.error, httplib.HTTPException):
+        # urllib2 doesn't wrap timeouts and bad responses in URLError
+        return None
+    return (time.time() - start) * 1000
+
+
+def latency_threshold():
+    return env.get('warm_up_latency_threshold', WARM_UP_LATENCY_THRESHOLD)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * percent / 100.0))]
+
+
+def sample_paths():
+    autoscaling_group = autoscale.get(asg_type='Active')
+    if not autoscaling_group:
+        return []
+    instances = [
+        instance
+        for instance in ec2.get_group_instances(
+            autoscaling_group=autoscaling_group)
+        if instance and instance.dns_name
+    ]
+    if not instances:
+        return []
+    utils.status('Sampling URLs from the live access log')
+    host = '%s@%s' % (env.get('instance_user', 'ubuntu'),
+                      instances[0].dns_name)
+    access_log = execute(read_access_log, hosts=[host])[host]
+    paths = collections.Counter(
+        match.group(1)
+        for match in (
+            ACCESS_LOG_PATTERN.search(line)
+            for line in access_log.splitlines()
+            if HEALTH_CHECKER not in line)
+        if match)
+    return [
+        path
+        for path, count in paths.most_common(
+            env.get('warm_up_sample_size', WARM_UP_SAMPLE_SIZE))
+    ]
+
+
+def read_access_log():
+    return sudo('tail -n %d %s' % (ACCESS_LOG_LINES, ACCESS_LOG), quiet=True)
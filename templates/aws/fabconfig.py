@@ -125,6 +125,42 @@ env.connections = utils.BotoConnection(
 
 env.bootstrap_folder = 'bootstrap'
 
+"""
+Keep a warm standby group of bootstrapped app instances for the next deploy
+to promote to QA, which then only has to update their config and containers
+over SSH rather than boot new instances. The standby instances run, and are
+billed, between deploys. ``env.instance_user`` is who we SSH in as.
+"""
+env.standby_pool = False
+env.instance_user = 'ubuntu'
+
+"""
+After confirm (or rollback) the group taken out of service is kept as the
+Inactive group at this many instances, for ``fab <environment> rollback`` to
+scale back up from. Set a retention in seconds to empty it after that long.
+
+Instances launched to scale it back up pull ``env.app_docker_image`` as it
+is now, which is the newest release unless the image name pins a release
+tag. So rollback refuses to scale past the warm instances unless it's run
+as ``rollback:cold=yes``. Keep the floor at ``env.asg_desired_capacity`` or
+pin the image tag per release for rollbacks that don't need that.
+"""
+env.inactive_warm_floor = 1
+env.inactive_retention = None
+
+"""
+``fab <environment> warm_up`` replays requests against the QA instances so
+they join the load balancer with warm workers and caches, run it between
+deploy and confirm. It requests these paths, or without them the most
+requested ones in an Active instance's nginx access log, a few at a time
+per instance until their 90th percentile latency is under the threshold in
+milliseconds. Set ``env.warm_up_auth`` to a (user, password) tuple if the
+QA URLs are behind basic auth.
+"""
+env.warm_up_urls = []
+env.warm_up_concurrency = 4
+env.warm_up_latency_threshold = 250
+
 
 @task
 def stage():
@@ -148,7 +184,9 @@ def stage():
 
     """
     The ID of your application base AMI. Having a base application AMI will speed
-    up your deployment process.
+    up your deployment process. ``fab stage bake`` builds an AMI on top of it
+    with the bootstrap's packages and docker images in place, and deploys
+    launch from that instead for as long as the bootstrap doesn't change.
     """
     env.ami_image_id = ''
 
@@ -180,7 +218,7 @@ def stage():
 def live():
     utils.status("Setting up LIVE")
     env.zone = 'your-domain.co.uk.'  # Base R53 zone, the dot is significant
-    env.qa_url = ['www.qa%s.your-domain.co.uk.']
+    env.qa_urls = ['www.qa%s.your-domain.co.uk.']
     env.urls = ['www.your-domain.co.uk']
     env.base_url = 'your-domain.co.uk'
     env.environment = 'live'
@@ -217,4 +255,8 @@ def live():
     The maximum size that your autoscaling group can grow to.
     """
     env.asg_max_size = 2
+
+    """
+    The ID of your application base AMI, see stage.
+    """
     env.ami_image_id = ''
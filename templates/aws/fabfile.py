@@ -1,38 +1,91 @@
 import sys
-import time
+import functools
 
 from tangentdeployer.aws import s3
+from tangentdeployer.aws import ami
 from tangentdeployer.aws import ec2
+from tangentdeployer.aws import graph
 from tangentdeployer.aws import elb
 from tangentdeployer.aws import route53
 from tangentdeployer.aws import autoscale
+from tangentdeployer.aws import standby
 from tangentdeployer.aws import utils
+from tangentdeployer.aws import waiter
+from tangentdeployer.aws import warmup
 
 from fabric.api import task
 from fabconfig import *  # noqa
 
 
 @task
+@utils.instrumented
 def deploy():
     utils.status("Deploying to QA %s" % env.environment)
     if autoscale.get(asg_type='QA'):
         utils.failure("There is already a QA autoscaling group, exiting")
         sys.exit(0)
-    s3.push_config_to_s3()
-    ec2.provision_logging_instance()
 
-    load_balancer = elb.get_or_create_load_balancer()
-    autoscaling_group = autoscale.create_autoscaling_group(
-        load_balancer=load_balancer)
+    """
+    Each step starts as soon as the steps it depends on have finished.
+    Instances and the logging box fetch their bootstrap files from S3 so
+    those wait on the config push, and the autoscaling group also waits to
+    find out whether there's a baked AMI to launch from. The load balancer
+    doesn't wait on anything.
+
+    With ``env.standby_pool`` on, a ready standby group is promoted to QA
+    instead of booting a new group, and once it has been the pool is
+    refilled in the background. Its instances are refreshed over SSH after
+    the steps, like the nagios config, since fabric isn't thread safe.
+    """
+    steps = graph.TaskGraph()
+    steps.add('config', s3.push_config_to_s3)
+    steps.add('image', ami.use_baked_image)
+    steps.add('logging', ec2.provision_logging_instance, requires=['config'])
+    steps.add('load_balancer', elb.get_or_create_load_balancer)
+    standby_group = standby.get_pool() if env.get('standby_pool') else None
+    if standby_group:
+        steps.add('autoscaling_group', functools.partial(
+            standby.promote, autoscaling_group=standby_group),
+            requires=['config', 'image'])
+    else:
+        steps.add('autoscaling_group', autoscale.create_autoscaling_group,
+                  requires=['config', 'image'],
+                  inputs={'load_balancer': 'load_balancer'})
+    if env.get('standby_pool'):
+        steps.add('standby', standby.refill,
+                  requires=['autoscaling_group'],
+                  inputs={'load_balancer': 'load_balancer'})
+    qa_urls_requires = []
     if env.environment == 'live':
-        autoscale.assign_elastic_ip_addresses(
-            autoscaling_group=autoscaling_group)
-    route53.link_qa_urls(autoscaling_group=autoscaling_group)
-    ec2.deploy_nagios_config(autoscaling_group=autoscaling_group)
+        steps.add('elastic_ips', autoscale.assign_elastic_ip_addresses,
+                  inputs={'autoscaling_group': 'autoscaling_group'})
+        qa_urls_requires.append('elastic_ips')
+    steps.add('qa_urls', route53.link_qa_urls,
+              requires=qa_urls_requires,
+              inputs={'autoscaling_group': 'autoscaling_group'})
+    results = steps.run()
+
+    if standby_group:
+        standby.refresh_instances(
+            autoscaling_group=results['autoscaling_group'])
+    ec2.deploy_nagios_config(autoscaling_group=results['autoscaling_group'])
     utils.success("Successfully deployed to QA %s" % env.environment)
 
 
 @task
+@utils.instrumented
+def warm_up():
+    utils.status("Warming up QA %s" % env.environment)
+    qa_autoscaling_group = autoscale.get(asg_type='QA')
+    if not qa_autoscaling_group:
+        utils.failure("There is no QA autoscaling group to warm up, exiting.")
+        sys.exit(0)
+    if warmup.warm_up(autoscaling_group=qa_autoscaling_group):
+        utils.success("The QA %s instances are warm" % env.environment)
+
+
+@task
+@utils.instrumented
 def confirm():
     utils.status("Confirm QA => %s deployment" % env.environment)
     active_autoscaling_group = autoscale.get(asg_type='Active')
@@ -40,24 +93,39 @@ def confirm():
     if not qa_autoscaling_group:
         utils.failure("There is no QA autoscaling group to confirm, exiting.")
         sys.exit(0)
-    autoscale.tag_qa_as_active()
-    autoscale.tag_active_as_inactive()
     load_balancer = elb.get(load_balancer_name=env.load_balancer_name)
+    utils.status('Registering QA instances with the load balancer')
     elb.register_instances(load_balancer=load_balancer,
                            autoscaling_group=qa_autoscaling_group)
+
+    """
+    We only remove the currently live infrastructure from the load balancer
+    once it reports every new instance as healthy. If they don't get there
+    in time we take them back out and leave everything else as it was, so
+    the live infrastructure keeps serving and QA can be looked at again.
+    """
+    utils.status('Waiting for the QA instances to pass the health check')
+    try:
+        elb.wait_for_healthy_instances(load_balancer=load_balancer,
+                                       autoscaling_group=qa_autoscaling_group)
+    except waiter.WaiterTimeout as e:
+        utils.failure(str(e))
+        elb.deregister_instances(load_balancer=load_balancer,
+                                 autoscaling_group=qa_autoscaling_group)
+        utils.failure("Aborted the %s cutover, the live instances are "
+                      "still serving" % env.environment)
+        sys.exit(1)
+
+    with autoscale.tag_batch():
+        autoscale.tag_inactive_as_old()
+        autoscale.tag_active_as_inactive()
+        autoscale.tag_qa_as_active()
     qa_autoscaling_group.resume_processes(
         scaling_processes=['AddToLoadBalancer'])
     route53.link_base_urls(load_balancer=load_balancer)
     route53.unlink_qa_urls(autoscaling_group=qa_autoscaling_group)
 
-    utils.status('Waiting 15 seconds before removing old instances')
-    """
-    We sleep here for 15 seconds before removing the currently live
-    infrastructure from the load balancer to be on the safe side. Removing the
-    live infrastructure before we've properly added the new infrastrucutre to
-    the load balancer would result in bad times.
-    """
-    time.sleep(15)
+    utils.status('Removing old instances from the load balancer')
     ec2.remove_nagios_config(autoscaling_group=active_autoscaling_group)
     elb.deregister_instances(load_balancer=load_balancer,
                              autoscaling_group=active_autoscaling_group)
@@ -66,17 +134,101 @@ def confirm():
     autoscale.scale_down(autoscaling_group=active_autoscaling_group)
 
     utils.status('Shutting down old autoscaling group')
-    autoscale.tag_inactive_as_old()
     old_autoscaling_group = autoscale.get(asg_type='Old')
     if old_autoscaling_group:
-        old_autoscaling_group.shutdown_instances()
-        old_autoscaling_group.delete(force_delete=True)
+        autoscale.delete(autoscaling_group=old_autoscaling_group)
         autoscale.delete_launch_config(
             autoscaling_group=old_autoscaling_group)
+    autoscale.collect_launch_configurations()
     utils.success("Successfully confirmed the %s deploy" % env.environment)
 
 
 @task
+@utils.instrumented
+def rollback(cold='no'):
+    utils.status("Rolling %s back to the previous release" % env.environment)
+    active_autoscaling_group = autoscale.get(asg_type='Active')
+    inactive_autoscaling_group = autoscale.get(asg_type='Inactive')
+    if not inactive_autoscaling_group:
+        utils.failure("There is no Inactive autoscaling group to roll back "
+                      "to, exiting.")
+        sys.exit(1)
+
+    """
+    Instances launched to scale the Inactive group back up pull the newest
+    app image, not the release we're rolling back to, unless
+    ``env.app_docker_image`` pins a release tag. So unless enough of the
+    group is still warm we only go ahead with ``rollback:cold=yes``.
+    """
+    warm_instances = autoscale.in_service(
+        autoscaling_group=inactive_autoscaling_group)
+    if len(warm_instances) < env.asg_desired_capacity and \
+            cold.lower() not in ('yes', 'true', '1'):
+        utils.failure("Only %d of %d instances in the Inactive group are "
+                      "warm, the rest would boot the current app image. Run "
+                      "rollback:cold=yes to roll back anyway." % (
+                          len(warm_instances), env.asg_desired_capacity))
+        sys.exit(1)
+    load_balancer = elb.get(load_balancer_name=env.load_balancer_name)
+
+    """
+    Like confirm, the release being rolled back keeps serving until every
+    instance we're rolling back to is healthy in the load balancer. If the
+    Inactive group doesn't get there it's scaled back down to its floor.
+    """
+    utils.status('Scaling the Inactive group back up')
+    try:
+        inactive_autoscaling_group = autoscale.scale_up(
+            autoscaling_group=inactive_autoscaling_group)
+        elb.register_instances(load_balancer=load_balancer,
+                               autoscaling_group=inactive_autoscaling_group)
+        utils.status('Waiting for the Inactive instances to pass the health '
+                     'check')
+        elb.wait_for_healthy_instances(
+            load_balancer=load_balancer,
+            autoscaling_group=inactive_autoscaling_group)
+    except waiter.WaiterTimeout as e:
+        utils.failure(str(e))
+        elb.deregister_instances(
+            load_balancer=load_balancer,
+            autoscaling_group=inactive_autoscaling_group)
+        autoscale.scale_down(autoscaling_group=inactive_autoscaling_group)
+        utils.failure("Aborted the %s rollback, the active instances are "
+                      "still serving" % env.environment)
+        sys.exit(1)
+
+    with autoscale.tag_batch():
+        autoscale.tag_active_as_inactive()
+        autoscale.tag_inactive_as_active()
+    inactive_autoscaling_group.resume_processes(
+        scaling_processes=['AddToLoadBalancer'])
+
+    """
+    With the tags swapped, the DNS and scaling changes don't depend on each
+    other. The nagios config goes over SSH, which isn't thread safe, so it
+    follows on the main thread.
+    """
+    steps = graph.TaskGraph()
+    steps.add('dns', functools.partial(
+        route53.link_base_urls, load_balancer=load_balancer))
+    steps.add('scaling', functools.partial(
+        autoscale.create_scaling_rules,
+        autoscaling_group=inactive_autoscaling_group))
+    steps.run()
+    ec2.replace_nagios_config(
+        new_autoscaling_group=inactive_autoscaling_group,
+        old_autoscaling_group=active_autoscaling_group)
+
+    if active_autoscaling_group:
+        utils.status('Removing rolled back instances from the load balancer')
+        elb.deregister_instances(load_balancer=load_balancer,
+                                 autoscaling_group=active_autoscaling_group)
+        autoscale.scale_down(autoscaling_group=active_autoscaling_group)
+    utils.success("Successfully rolled %s back" % env.environment)
+
+
+@task
+@utils.instrumented
 def abort():
     utils.status("Aborting %s QA deploy" % env.environment)
     qa_autoscaling_group = autoscale.get(asg_type='QA')
@@ -84,14 +236,22 @@ def abort():
         utils.failure('No QA %s environment exists' % env.environment)
         sys.exit(1)
     ec2.remove_nagios_config(autoscaling_group=qa_autoscaling_group)
-    qa_autoscaling_group.shutdown_instances()
-    qa_autoscaling_group.delete(force_delete=True)
+    autoscale.delete(autoscaling_group=qa_autoscaling_group)
     autoscale.delete_launch_config(autoscaling_group=qa_autoscaling_group)
+    autoscale.collect_launch_configurations()
     utils.success(
         "Successfully aborted the %s QA deploy" % env.environment)
 
 
 @task
+@utils.instrumented
+def bake():
+    s3.push_config_to_s3()
+    ami.bake()
+
+
+@task
+@utils.instrumented
 def logging():
     s3.push_config_to_s3()
     ec2.provision_logging_instance()